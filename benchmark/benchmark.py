@@ -0,0 +1,161 @@
+#! /usr/bin/env python3
+
+"""
+Offline benchmark of the zspotify download pipeline.
+Runs against a local mock of the Web API and a fake audio stream, so no account or network is needed.
+
+    python benchmark/benchmark.py --tracks 200 --latency 20 --bandwidth 2048
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'zspotify'))
+
+from librespot.audio.decoders import AudioQuality  # noqa: E402
+
+import album  # noqa: E402
+import artwork  # noqa: E402
+import const  # noqa: E402
+import journal  # noqa: E402
+import library  # noqa: E402
+import playlist  # noqa: E402
+import podcast  # noqa: E402
+import stats  # noqa: E402
+import track  # noqa: E402
+from cache import MetadataCache  # noqa: E402
+from const import CONFIG_DEFAULT_SETTINGS, ROOT_PATH, SCRATCH_PATH, METADATA_CACHE, ARTWORK_CACHE, \
+    ARTWORK_CACHE_ENTRIES, ARTWORK_MAX_SIZE, ARTWORK_QUALITY  # noqa: E402
+from zspotify import ZSpotify  # noqa: E402
+
+from mockspotify import API_URL, MockWebApi, FakeSession, make_audio  # noqa: E402
+
+SCENARIOS = ('playlist', 'album', 'listing')
+
+
+def parse_config(values):
+    """ Parses KEY=VALUE overrides, values are json where possible """
+    config = {}
+    for value in values:
+        key, _, raw = value.partition('=')
+        try:
+            config[key] = json.loads(raw)
+        except ValueError:
+            config[key] = raw
+    return config
+
+
+def setup(args, workdir: str, api: MockWebApi, session: FakeSession) -> None:
+    """ Points zspotify at the mocks and keeps every file it writes inside workdir """
+    for module in (const, track, album, playlist, podcast):
+        for name, value in vars(module).items():
+            if isinstance(value, str) and value.startswith(API_URL):
+                setattr(module, name, api.api_url + value[len(API_URL):])
+
+    ZSpotify.CONFIG = {**CONFIG_DEFAULT_SETTINGS, ROOT_PATH: os.path.join(workdir, 'music'),
+                       SCRATCH_PATH: os.path.join(workdir, 'scratch'), METADATA_CACHE: False,
+                       **parse_config(args.config)}
+    ZSpotify.SESSION = session
+    ZSpotify.DOWNLOAD_QUALITY = AudioQuality.VERY_HIGH
+    if ZSpotify.get_config(METADATA_CACHE):
+        ZSpotify.METADATA_CACHE = MetadataCache(os.path.join(workdir, 'metadata.db'))
+    if ZSpotify.get_config(ARTWORK_CACHE):
+        artwork.ARTWORK_CACHE_INSTANCE = artwork.ArtworkCache(
+            os.path.join(workdir, 'artwork'), ZSpotify.get_config(ARTWORK_CACHE_ENTRIES),
+            ZSpotify.get_config(ARTWORK_MAX_SIZE), ZSpotify.get_config(ARTWORK_QUALITY))
+    journal.JOURNAL = journal.DownloadJournal(os.path.join(workdir, 'journal.jsonl'))
+    library.LIBRARY_INDEX = None
+
+
+def run(args, api: MockWebApi) -> int:
+    """ Runs the scenario, returns the number of tracks it went through """
+    catalog = api.catalog
+    if args.scenario == 'playlist':
+        playlist.download_playlist({const.ID: catalog.playlist_id, const.NAME: 'Benchmark Playlist'})
+    elif args.scenario == 'album':
+        album.download_artist_albums(catalog.artist_id)
+    else:
+        return sum(1 for _ in playlist.iter_playlist_songs(catalog.playlist_id))
+    return len(catalog.track_ids)
+
+
+def get_written_bytes(directory: str) -> int:
+    return sum(os.path.getsize(os.path.join(path, name))
+               for path, _, names in os.walk(directory) for name in names if not name.startswith('.'))
+
+
+def report(args, results: dict) -> None:
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    tracks = results['tracks'] or 1
+    print(f'\n{args.scenario} benchmark, {results["tracks"]} tracks, {results["workers"]} workers')
+    print(f'  elapsed           {results["elapsed"]:.2f} s')
+    print(f'  tracks/sec        {results["tracks_per_sec"]:.2f}')
+    print(f'  API calls/track   {results["api_calls"] / tracks:.3f} ({results["api_calls"]} calls, '
+          f'{results["rate_limited"]} rate limited)')
+    print(f'  bytes read/track  {results["bytes_read"] / tracks / 1024:.1f} KiB')
+    print(f'  bytes/track       {results["bytes_written"] / tracks / 1024:.1f} KiB written')
+    print('  ' + ', '.join(f'{status}: {number}' for status, number in sorted(results['statuses'].items())))
+    print('  ' + ', '.join(f'{name}: {value}' for name, value in sorted(results['counters'].items())))
+    print(f'  {"stage":<17}{"total s":>8}{"ms/track":>10}{"p50 ms":>9}{"p90 ms":>9}{"p99 ms":>9}')
+    for stage, values in sorted(results['stages'].items()):
+        print(f'  {stage:<17}{values["total"]:>8.2f}{values["total"] * 1000 / tracks:>10.1f}' +
+              ''.join(f'{values[key] * 1000:>9.1f}' for key in ('p50', 'p90', 'p99')))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks zspotify against a local Spotify stand-in.')
+    parser.add_argument('--scenario', choices=SCENARIOS, default='playlist',
+                        help='playlist downloads one playlist, album an artist discography, '
+                             'listing only pages through the playlist.')
+    parser.add_argument('--tracks', type=int, default=100, help='Number of tracks in the catalog.')
+    parser.add_argument('--duration', type=int, default=30, help='Length in seconds of each track.')
+    parser.add_argument('--latency', type=float, default=0, help='Milliseconds added to every API request '
+                                                                  'and stream open.')
+    parser.add_argument('--bandwidth', type=float, default=0, help='KiB/s of each audio stream, 0 is unlimited.')
+    parser.add_argument('--rate-limited', type=float, default=0, help='Share of API requests answered with 429.')
+    parser.add_argument('--retry-after', type=int, default=0, help='Retry-After seconds sent with each 429.')
+    parser.add_argument('-c', '--config', action='append', default=[], metavar='KEY=VALUE',
+                        help='Overrides a config option, e.g. -c DOWNLOAD_FORMAT=mp3 -c DOWNLOAD_WORKERS=8')
+    parser.add_argument('--json', action='store_true', help='Prints the results as json.')
+    parser.add_argument('--stats', metavar='FILE', help='Writes the stats of every song to FILE as json lines.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='zspotify-benchmark-') as workdir:
+        latency = args.latency / 1000
+        api = MockWebApi(args.tracks, latency, args.rate_limited, args.retry_after).start()
+        session = FakeSession(make_audio(os.path.join(workdir, 'sample.ogg'), args.duration),
+                              latency, args.bandwidth * 1024)
+        setup(args, workdir, api, session)
+        run_stats = stats.enable_stats(args.stats)
+
+        start = time.perf_counter()
+        tracks = run(args, api)
+        elapsed = time.perf_counter() - start
+        api.shutdown()
+        summary = run_stats.summary()
+        run_stats.close()
+
+        report(args, {
+            'scenario': args.scenario,
+            'tracks': tracks,
+            'workers': ZSpotify.get_config(const.DOWNLOAD_WORKERS),
+            'elapsed': elapsed,
+            'tracks_per_sec': tracks / elapsed,
+            'api_calls': api.api_calls(),
+            'rate_limited': api.calls['429'],
+            'streams': session.streams,
+            'bytes_read': session.bytes_read,
+            'bytes_written': get_written_bytes(os.path.join(workdir, 'music')),
+            'statuses': summary['statuses'],
+            'counters': summary['counters'],
+            'stages': summary['stages'],
+        })
+
+
+if __name__ == '__main__':
+    main()
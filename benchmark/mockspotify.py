@@ -0,0 +1,269 @@
+"""
+Local stand-ins for the Spotify Web API and the librespot session, used by benchmark.py
+"""
+import io
+import json
+import random
+import re
+import subprocess
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+from PIL import Image
+
+API_URL = 'https://api.spotify.com/v1'
+BASE62 = '0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
+TRACKS_PER_ALBUM = 12
+# bytes Spotify puts before the ogg data of a song
+HEADER_SIZE = 0xa7
+
+
+def make_id(kind: str, number: int) -> str:
+    """ Returns a deterministic 22 character base62 id """
+    value = number * 97 + sum(map(ord, kind)) * 1000003
+    chars = []
+    for _ in range(22):
+        value, digit = divmod(value, 62)
+        chars.append(BASE62[digit])
+    return ''.join(reversed(chars))
+
+
+def make_audio(path: str, duration: int) -> bytes:
+    """ Renders a sine tone into an ogg vorbis file with ffmpeg, the format Spotify streams """
+    subprocess.run(['ffmpeg', '-y', '-hide_banner', '-loglevel', 'error', '-f', 'lavfi',
+                    '-i', f'sine=frequency=440:duration={duration}', '-c:a', 'libvorbis', '-q:a', '5', path],
+                   check=True)
+    with open(path, 'rb') as file:
+        return file.read()
+
+
+def make_artwork(size: int = 640) -> bytes:
+    output = io.BytesIO()
+    Image.new('RGB', (size, size), (30, 215, 96)).save(output, format='JPEG', quality=90)
+    return output.getvalue()
+
+
+class Catalog:
+    """ One artist with a playlist of every track, the tracks grouped into albums """
+
+    def __init__(self, tracks: int, base_url: str):
+        self.base_url = base_url
+        self.artist_id = make_id('artist', 0)
+        self.playlist_id = make_id('playlist', 0)
+        self.track_ids = [make_id('track', n) for n in range(tracks)]
+        self.album_ids = [make_id('album', n) for n in range(0, tracks, TRACKS_PER_ALBUM)]
+        self.tracks = {track_id: n for n, track_id in enumerate(self.track_ids)}
+        self.albums = {album_id: n for n, album_id in enumerate(self.album_ids)}
+
+    def album(self, album_id: str, with_tracks=False) -> dict:
+        n = self.albums[album_id]
+        album = {
+            'id': album_id,
+            'name': f'Album {n + 1}',
+            'artists': [{'id': self.artist_id, 'name': 'Benchmark Artist'}],
+            'release_date': '2020-01-01',
+            'images': [{'url': f'{self.base_url}/image/{album_id}.jpg', 'width': 640, 'height': 640}],
+        }
+        if with_tracks:
+            album['tracks'] = self.page(self.album_tracks(album_id), 50, 0, simplified=True)
+        return album
+
+    def album_tracks(self, album_id: str) -> List[str]:
+        start = self.albums[album_id] * TRACKS_PER_ALBUM
+        return self.track_ids[start:start + TRACKS_PER_ALBUM]
+
+    def track(self, track_id: str, simplified=False) -> dict:
+        n = self.tracks[track_id]
+        track = {
+            'id': track_id,
+            'name': f'Track {n + 1}',
+            'artists': [{'id': self.artist_id, 'name': 'Benchmark Artist'}],
+            'disc_number': 1,
+            'track_number': n % TRACKS_PER_ALBUM + 1,
+            'duration_ms': 30000,
+            'is_playable': True,
+        }
+        if not simplified:
+            track['album'] = self.album(self.album_ids[n // TRACKS_PER_ALBUM])
+        return track
+
+    def page(self, ids: List[str], limit: int, offset: int, simplified=False, wrap=False) -> dict:
+        items = [self.track(track_id, simplified) for track_id in ids[offset:offset + limit]]
+        if wrap:
+            items = [{'track': item} for item in items]
+        return {'items': items, 'total': len(ids), 'limit': limit, 'offset': offset,
+                'next': None if offset + limit >= len(ids) else f'offset={offset + limit}'}
+
+
+class MockWebApi(ThreadingHTTPServer):
+    """ Serves the Web API endpoints zspotify uses from a Catalog on a local port """
+    daemon_threads = True
+
+    def __init__(self, tracks: int, latency: float = 0.0, error_rate: float = 0.0, retry_after: int = 0):
+        super().__init__(('127.0.0.1', 0), MockWebApiHandler)
+        self.base_url = f'http://127.0.0.1:{self.server_address[1]}'
+        self.catalog = Catalog(tracks, self.base_url)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.artwork = make_artwork()
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        self.random = random.Random(0)
+
+    @property
+    def api_url(self) -> str:
+        return f'{self.base_url}/v1'
+
+    def start(self) -> 'MockWebApi':
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def count(self, kind: str) -> bool:
+        """ Counts a request and returns whether it should be rejected with a 429 """
+        with self.lock:
+            self.calls[kind] += 1
+            if kind != 'image' and self.random.random() < self.error_rate:
+                self.calls['429'] += 1
+                return True
+        return False
+
+    def api_calls(self) -> int:
+        return sum(count for kind, count in self.calls.items() if kind not in ('image', '429'))
+
+    def route(self, path: str, query: Dict[str, List[str]]) -> Optional[dict]:
+        catalog = self.catalog
+        limit = int(query.get('limit', ['50'])[0])
+        offset = int(query.get('offset', ['0'])[0])
+        ids = query.get('ids', [''])[0].split(',')
+
+        if path == '/v1/tracks':
+            return {'tracks': [catalog.track(track_id) if track_id in catalog.tracks else None for track_id in ids]}
+        if path == '/v1/albums':
+            return {'albums': [catalog.album(album_id, with_tracks=True) if album_id in catalog.albums else None
+                               for album_id in ids]}
+        if path == '/v1/me/tracks':
+            return catalog.page(catalog.track_ids, limit, offset, wrap=True)
+
+        match = re.fullmatch(r'/v1/(\w+)/(\w+)(?:/(\w+))?', path)
+        if not match:
+            return None
+        kind, object_id, child = match.groups()
+        if kind == 'playlists' and object_id == catalog.playlist_id:
+            if child == 'tracks':
+                return catalog.page(catalog.track_ids, limit, offset, wrap=True)
+            return {'id': object_id, 'name': 'Benchmark Playlist', 'snapshot_id': 'snapshot',
+                    'owner': {'display_name': 'benchmark'}}
+        if kind == 'albums' and object_id in catalog.albums:
+            if child == 'tracks':
+                return catalog.page(catalog.album_tracks(object_id), limit, offset, simplified=True)
+            return catalog.album(object_id, with_tracks=True)
+        if kind == 'artists' and object_id == catalog.artist_id and child == 'albums':
+            items = [catalog.album(album_id) for album_id in catalog.album_ids[offset:offset + limit]]
+            return {'items': items, 'total': len(catalog.album_ids), 'limit': limit, 'offset': offset}
+        return None
+
+
+class MockWebApiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        server: MockWebApi = self.server
+        if server.latency:
+            time.sleep(server.latency)
+
+        if url.path.startswith('/image/'):
+            server.count('image')
+            self.send(200, server.artwork, 'image/jpeg')
+            return
+        if server.count(url.path.split('/')[2] if url.path.count('/') > 1 else url.path):
+            self.send(429, b'{"error": {"status": 429}}', headers={'Retry-After': str(server.retry_after)})
+            return
+        data = server.route(url.path, parse_qs(url.query))
+        if data is None:
+            self.send(404, b'{"error": {"status": 404}}')
+        else:
+            self.send(200, json.dumps(data).encode('utf-8'))
+
+    def send(self, status: int, body: bytes, content_type='application/json', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeAudioStream:
+    """ Replays the sample audio at a limited bandwidth, like librespot's decrypted input stream """
+
+    def __init__(self, audio: bytes, bandwidth: float, session: 'FakeSession'):
+        self.audio = bytes(HEADER_SIZE) + audio
+        self.size = len(self.audio)
+        self.bandwidth = bandwidth
+        self.session = session
+        # librespot hands out the stream already past Spotify's header
+        self.position = HEADER_SIZE
+
+    def stream(self) -> 'FakeAudioStream':
+        return self
+
+    def pos(self) -> int:
+        return self.position
+
+    def seek(self, position: int) -> None:
+        self.position = position
+
+    def read(self, size: int) -> bytes:
+        data = self.audio[self.position:self.position + size]
+        self.position += len(data)
+        if self.bandwidth:
+            time.sleep(len(data) / self.bandwidth)
+        self.session.add_bytes(len(data))
+        return data
+
+
+class FakeSession:
+    """ Stands in for librespot's Session: hands out tokens and audio streams without logging in """
+
+    def __init__(self, audio: bytes, latency: float = 0.0, bandwidth: float = 0.0):
+        self.audio = audio
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.streams = 0
+        self.bytes_read = 0
+        self.lock = threading.Lock()
+
+    def add_bytes(self, count: int) -> None:
+        with self.lock:
+            self.bytes_read += count
+
+    def tokens(self) -> 'FakeSession':
+        return self
+
+    def get_token(self, *scopes):
+        return type('Token', (), {'access_token': 'benchmark', 'expires_in': 3600,
+                                  'timestamp': int(time.time() * 1000000)})()
+
+    def content_feeder(self) -> 'FakeSession':
+        return self
+
+    def load(self, content_id, quality, preload, halt_listener):
+        # opening a stream costs a few round trips to Spotify's servers
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.streams += 1
+        return type('LoadedStream', (), {'input_stream': FakeAudioStream(self.audio, self.bandwidth, self)})()
+
+    def get_user_attribute(self, key):
+        return 'premium'
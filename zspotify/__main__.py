@@ -10,6 +10,17 @@ if __name__ == '__main__':
     parser.add_argument('-ns', '--no-splash',
                         action='store_true',
                         help='Suppress the splash screen when loading.')
+    parser.add_argument('-r', '--resume',
+                        action='store_true',
+                        help='Continues interrupted downloads where they stopped instead of starting over.')
+    parser.add_argument('--sync',
+                        action='store_true',
+                        help='Only downloads songs added to a playlist since it was last downloaded and skips unchanged playlists.')
+    parser.add_argument('--stats',
+                        nargs='?',
+                        const='',
+                        metavar='FILE',
+                        help='Prints how long each stage of the downloads took at the end, writing a json line per song to FILE if given.')
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument('urls',
                        type=str,
@@ -1,7 +1,9 @@
-from tqdm import tqdm
+import asyncio
 
-from const import ITEMS, ARTISTS, NAME, ID
-from track import download_track
+from const import ARTISTS, NAME, ID, ALBUM, ARTIST, ALBUMS, TRACK, TRACKS, ITEMS, TOTAL, IS_PLAYABLE, \
+    ALBUMS_PER_REQUEST
+from asyncapi import AsyncZSpotify, iter_url_paginated, invoke_urls
+from track import download_tracks
 from utils import fix_filename
 from zspotify import ZSpotify
 
@@ -9,54 +11,93 @@ ALBUM_URL = 'https://api.spotify.com/v1/albums'
 ARTIST_URL = 'https://api.spotify.com/v1/artists'
 
 
-def get_album_tracks(album_id):
-    """ Returns album tracklist """
-    songs = []
-    offset = 0
-    limit = 50
+def iter_album_tracks(album_id):
+    """ Yields album tracklist page by page """
+    return iter_url_paginated(f'{ALBUM_URL}/{album_id}/tracks', limit=50, cache_kind=ALBUM)
 
-    while True:
-        resp = ZSpotify.invoke_url_with_params(f'{ALBUM_URL}/{album_id}/tracks', limit=limit, offset=offset)
-        offset += limit
-        songs.extend(resp[ITEMS])
-        if len(resp[ITEMS]) < limit:
-            break
 
-    return songs
+def get_album_tracks(album_id):
+    """ Returns album tracklist """
+    return list(iter_album_tracks(album_id))
 
 
 def get_album_name(album_id):
     """ Returns album name """
-    resp = ZSpotify.invoke_url(f'{ALBUM_URL}/{album_id}')
+    resp = ZSpotify.invoke_url(f'{ALBUM_URL}/{album_id}', cache_kind=ALBUM)
     return resp[ARTISTS][0][NAME], fix_filename(resp[NAME])
 
 
+def iter_artist_albums(artist_id):
+    """ Yields the id of each of the artist's albums, including singles an EPs """
+    albums = iter_url_paginated(f'{ARTIST_URL}/{artist_id}/albums', limit=50, cache_kind=ARTIST,
+                                include_groups='album,single')
+    return (album[ID] for album in albums)
+
+
 def get_artist_albums(artist_id):
     """ Returns artist's albums """
-    resp = ZSpotify.invoke_url(f'{ARTIST_URL}/{artist_id}/albums?include_groups=album%2Csingle')
-    # Return a list each album's id
-    album_ids = [resp[ITEMS][i][ID] for i in range(len(resp[ITEMS]))]
-    # Recursive requests to get all albums including singles an EPs
-    while resp['next'] is not None:
-        resp = ZSpotify.invoke_url(resp['next'])
-        album_ids.extend([resp[ITEMS][i][ID] for i in range(len(resp[ITEMS]))])
+    return list(iter_artist_albums(artist_id))
+
+
+async def get_remaining_album_tracks(albums) -> list:
+    """ Returns the pages of tracks left out of the album objects, requested at once """
+    return list(await asyncio.gather(*(
+        AsyncZSpotify.invoke_pages(f'{ALBUM_URL}/{album[ID]}/tracks', 50,
+                                   range(len(album[TRACKS][ITEMS]), album[TRACKS][TOTAL], 50), cache_kind=ALBUM)
+        for album in albums)))
+
+
+def get_albums_info(album_ids) -> dict:
+    """ Retrieves albums with their full tracklists, ALBUMS_PER_REQUEST ids per request, all requests at once """
+    albums = {}
+    missing_ids = []
+    for album_id in album_ids:
+        album = ZSpotify.get_cached(ALBUM, album_id)
+        if album:
+            albums[album_id] = album
+        else:
+            missing_ids.append(album_id)
+
+    batches = [missing_ids[i:i + ALBUMS_PER_REQUEST] for i in range(0, len(missing_ids), ALBUMS_PER_REQUEST)]
+    responses = invoke_urls([f'{ALBUM_URL}?ids={",".join(batch)}&market=from_token' for batch in batches])
+    fetched = [album for resp in responses for album in resp[ALBUMS] if album]
+
+    # album objects only carry the first 50 tracks
+    long_albums = [album for album in fetched if len(album[TRACKS][ITEMS]) < album[TRACKS][TOTAL]]
+    if long_albums:
+        pages = AsyncZSpotify.run(get_remaining_album_tracks(long_albums)).result()
+        for album, album_pages in zip(long_albums, pages):
+            for page in album_pages:
+                album[TRACKS][ITEMS].extend(page[ITEMS])
+
+    for album in fetched:
+        ZSpotify.put_cached(ALBUM, album[ID], album)
+        albums[album[ID]] = album
+        # the album already holds everything download_tracks needs, which saves looking the tracks up again
+        album_info = {key: value for key, value in album.items() if key != TRACKS}
+        for track in album[TRACKS][ITEMS]:
+            if IS_PLAYABLE in track:
+                ZSpotify.put_cached(TRACK, track[ID], {**track, ALBUM: album_info})
+    return albums
+
 
-    return album_ids
+def download_album_info(album):
+    """ Downloads songs from an album object with its full tracklist """
+    artist_fixed = fix_filename(album[ARTISTS][0][NAME])
+    album_name_fixed = fix_filename(album[NAME])
+    download_tracks((track[ID] for track in album[TRACKS][ITEMS]), f'{artist_fixed}/{album_name_fixed}',
+                    prefix=True, desc=album[NAME], total=len(album[TRACKS][ITEMS]))
 
 
 def download_album(album):
     """ Downloads songs from an album """
-    artist, album_name = get_album_name(album)
-    artist_fixed = fix_filename(artist)
-    album_name_fixed = fix_filename(album_name)
-    tracks = get_album_tracks(album)
-    for n, track in tqdm(enumerate(tracks, start=1), unit_scale=True, unit='Song', total=len(tracks)):
-        download_track(track[ID], f'{artist_fixed}/{album_name_fixed}',
-                       prefix=True, prefix_value=str(n), disable_progressbar=True)
+    download_album_info(get_albums_info([album])[album])
 
 
 def download_artist_albums(artist):
     """ Downloads albums of an artist """
-    albums = get_artist_albums(artist)
-    for album_id in albums:
-        download_album(album_id)
+    album_ids = get_artist_albums(artist)
+    albums = get_albums_info(album_ids)
+    for album_id in album_ids:
+        if album_id in albums:
+            download_album_info(albums[album_id])
@@ -1,13 +1,18 @@
+from operator import length_hint
+
 from librespot.audio.decoders import AudioQuality
 from tabulate import tabulate
+from tqdm import tqdm
 
 from album import download_album, download_artist_albums
 from const import TRACK, NAME, ID, ARTIST, ARTISTS, ITEMS, TRACKS, EXPLICIT, ALBUM, ALBUMS, \
     OWNER, PLAYLIST, PLAYLISTS, DISPLAY_NAME
-from playlist import get_playlist_songs, get_playlist_info, download_from_user_playlist, download_playlist
-from podcast import download_episode, get_show_episodes
-from track import download_track, get_saved_tracks
-from utils import fix_filename, splash, split_input, regex_input_for_urls
+from metrics import start_metrics
+from playlist import get_playlist_info, download_from_user_playlist, download_playlist
+from podcast import download_episode, iter_show_episodes
+from stats import enable_stats, print_summary
+from track import download_track, download_tracks, iter_saved_tracks
+from utils import splash, split_input, regex_input_for_urls
 from zspotify import ZSpotify
 
 SEARCH_URL = 'https://api.spotify.com/v1/search'
@@ -16,6 +21,11 @@ SEARCH_URL = 'https://api.spotify.com/v1/search'
 def client(args) -> None:
     """ Connects to spotify to perform query's and get songs to download """
     ZSpotify()
+    ZSpotify.RESUME = args.resume
+    ZSpotify.SYNC = args.sync
+    if args.stats is not None:
+        enable_stats(args.stats or None)
+    start_metrics()
 
     if not args.no_splash:
         splash()
@@ -41,29 +51,27 @@ def client(args) -> None:
             elif album_id is not None:
                 download_album(album_id)
             elif playlist_id is not None:
-                playlist_songs = get_playlist_songs(playlist_id)
                 name, _ = get_playlist_info(playlist_id)
-                for song in playlist_songs:
-                    download_track(song[TRACK][ID],
-                                   fix_filename(name) + '/')
-                    print('\n')
+                download_playlist({ID: playlist_id, NAME: name}, prefix=False)
             elif episode_id is not None:
                 download_episode(episode_id)
             elif show_id is not None:
-                for episode in get_show_episodes(show_id):
+                for episode in iter_show_episodes(show_id):
                     download_episode(episode)
 
     if args.playlist:
         download_from_user_playlist()
 
     if args.liked_songs:
-        for song in get_saved_tracks():
-            if not song[TRACK][NAME]:
-                print(
-                    '###   SKIPPING:  SONG DOES NOT EXIST ON SPOTIFY ANYMORE   ###')
-            else:
-                download_track(song[TRACK][ID], 'Liked Songs/')
-            print('\n')
+        songs = iter_saved_tracks()
+
+        def liked_songs():
+            for song in songs:
+                if not song[TRACK][NAME]:
+                    tqdm.write('###   SKIPPING:  SONG DOES NOT EXIST ON SPOTIFY ANYMORE   ###')
+                else:
+                    yield song[TRACK][ID]
+        download_tracks(liked_songs(), 'Liked Songs/', desc='Liked Songs', total=length_hint(songs))
 
     if args.search_spotify:
         search_text = ''
@@ -80,19 +88,19 @@ def client(args) -> None:
         elif album_id is not None:
             download_album(album_id)
         elif playlist_id is not None:
-            playlist_songs = get_playlist_songs(playlist_id)
             name, _ = get_playlist_info(playlist_id)
-            for song in playlist_songs:
-                download_track(song[TRACK][ID], fix_filename(name) + '/')
-                print('\n')
+            download_playlist({ID: playlist_id, NAME: name}, prefix=False)
         elif episode_id is not None:
             download_episode(episode_id)
         elif show_id is not None:
-            for episode in get_show_episodes(show_id):
+            for episode in iter_show_episodes(show_id):
                 download_episode(episode)
         else:
             search(search_text)
 
+    if args.stats is not None:
+        print_summary()
+
 
 def search(search_term):
     """ Searches Spotify's API for relevant data """
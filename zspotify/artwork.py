@@ -0,0 +1,100 @@
+import hashlib
+import io
+import os
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+from const import ARTWORK_CACHE, ARTWORK_CACHE_DIR_PATH, ARTWORK_CACHE_ENTRIES, ARTWORK_MAX_SIZE, ARTWORK_QUALITY
+from zspotify import ZSpotify
+
+ARTWORK_CACHE_INSTANCE = None
+ARTWORK_CACHE_INSTANCE_LOCK = threading.Lock()
+
+
+def download_artwork(image_url: str) -> bytes:
+    """ Downloads cover art, raising on error responses so they are never embedded or cached """
+    resp = ZSpotify.http_get(image_url)
+    resp.raise_for_status()
+    return resp.content
+
+
+def resize_artwork(image: bytes, max_size: int, quality: int) -> bytes:
+    """ Shrinks artwork to fit in max_size x max_size pixels, re-encoded as jpeg """
+    with Image.open(io.BytesIO(image)) as img:
+        if max(img.size) <= max_size:
+            return image
+        img.thumbnail((max_size, max_size))
+        output = io.BytesIO()
+        img.convert('RGB').save(output, format='JPEG', quality=quality, optimize=True)
+        return output.getvalue()
+
+
+class ArtworkCache:
+    """ Cover art cached in memory (least recently used first out) and on disk, keyed by image url """
+
+    def __init__(self, directory: str, max_entries: int, max_size: int, quality: int):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.quality = quality
+        self.images = OrderedDict()
+        self.lock = threading.Lock()
+        # one lock per url so tracks of the same album wait for a single download
+        self.url_locks = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self, image_url: str) -> bytes:
+        with self.lock:
+            if image_url in self.images:
+                self.images.move_to_end(image_url)
+                return self.images[image_url]
+            url_lock = self.url_locks.setdefault(image_url, threading.Lock())
+
+        with url_lock:
+            with self.lock:
+                image = self.images.get(image_url)
+            if image is None:
+                image = self.load(image_url)
+            with self.lock:
+                self.images[image_url] = image
+                self.images.move_to_end(image_url)
+                while len(self.images) > self.max_entries:
+                    self.images.popitem(last=False)
+                self.url_locks.pop(image_url, None)
+        return image
+
+    def load(self, image_url: str) -> bytes:
+        """ Reads artwork from disk, downloading and resizing it first if it is not there """
+        key = hashlib.sha1(f'{image_url}:{self.max_size}:{self.quality}'.encode('utf-8')).hexdigest()
+        path = os.path.join(self.directory, f'{key}.jpg')
+        if os.path.isfile(path):
+            with open(path, 'rb') as file:
+                return file.read()
+
+        image = download_artwork(image_url)
+        if self.max_size:
+            image = resize_artwork(image, self.max_size, self.quality)
+        temp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(temp_path, 'wb') as file:
+            file.write(image)
+        os.replace(temp_path, path)
+        return image
+
+
+def get_artwork(image_url: str) -> bytes:
+    """ Returns the cover art at image_url, through the artwork cache unless ARTWORK_CACHE is disabled """
+    global ARTWORK_CACHE_INSTANCE
+    if not ZSpotify.get_config(ARTWORK_CACHE):
+        image = download_artwork(image_url)
+        max_size = ZSpotify.get_config(ARTWORK_MAX_SIZE)
+        return resize_artwork(image, max_size, ZSpotify.get_config(ARTWORK_QUALITY)) if max_size else image
+    with ARTWORK_CACHE_INSTANCE_LOCK:
+        if ARTWORK_CACHE_INSTANCE is None:
+            ARTWORK_CACHE_INSTANCE = ArtworkCache(
+                os.path.join(os.path.dirname(__file__), ARTWORK_CACHE_DIR_PATH),
+                ZSpotify.get_config(ARTWORK_CACHE_ENTRIES),
+                ZSpotify.get_config(ARTWORK_MAX_SIZE),
+                ZSpotify.get_config(ARTWORK_QUALITY))
+    return ARTWORK_CACHE_INSTANCE.get(image_url)
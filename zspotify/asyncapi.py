@@ -0,0 +1,207 @@
+import asyncio
+import atexit
+import threading
+from concurrent.futures import Future
+from typing import Any, Iterator, List, Optional, Tuple
+
+import aiohttp
+
+from const import LIMIT, OFFSET, ITEMS, TOTAL, API_MAX_RETRIES, API_PAGINATION_WORKERS, HTTP_POOL_SIZE, HTTP_TIMEOUT, \
+    HTTP_RETRIES
+from stats import count
+from zspotify import ZSpotify
+
+
+class AsyncZSpotify:
+    """ asyncio counterpart of the ZSpotify Web API methods, sharing its tokens, rate limiter and metadata cache.
+    Everything runs on one background event loop so a single connection pool serves every thread """
+    LOOP: asyncio.AbstractEventLoop = None
+    LOOP_LOCK = threading.Lock()
+    HTTP_SESSION: aiohttp.ClientSession = None
+
+    @classmethod
+    def get_loop(cls) -> asyncio.AbstractEventLoop:
+        """ Returns the event loop, starting its thread on first use """
+        with cls.LOOP_LOCK:
+            if cls.LOOP is None:
+                cls.LOOP = asyncio.new_event_loop()
+                threading.Thread(target=cls.LOOP.run_forever, name='zspotify-api', daemon=True).start()
+                atexit.register(cls.close)
+            return cls.LOOP
+
+    @classmethod
+    def run(cls, coro) -> Future:
+        """ Schedules a coroutine on the event loop, callable from any thread """
+        return asyncio.run_coroutine_threadsafe(coro, cls.get_loop())
+
+    @classmethod
+    def close(cls) -> None:
+        if cls.HTTP_SESSION is not None:
+            cls.run(cls.HTTP_SESSION.close()).result()
+            cls.HTTP_SESSION = None
+        cls.LOOP.call_soon_threadsafe(cls.LOOP.stop)
+
+    @classmethod
+    def get_http_session(cls) -> aiohttp.ClientSession:
+        # only called on the loop thread, so it needs no lock
+        if cls.HTTP_SESSION is None:
+            cls.HTTP_SESSION = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit_per_host=ZSpotify.get_config(HTTP_POOL_SIZE)),
+                timeout=aiohttp.ClientTimeout(total=ZSpotify.get_config(HTTP_TIMEOUT)))
+        return cls.HTTP_SESSION
+
+    @classmethod
+    async def get(cls, url, params=None, headers=None) -> aiohttp.ClientResponse:
+        """ Returns the response of a GET request with its body read,
+        retrying HTTP_RETRIES times on connection errors and timeouts like the requests session """
+        retries = ZSpotify.get_config(HTTP_RETRIES)
+        for attempt in range(retries + 1):
+            try:
+                async with cls.get_http_session().get(url, params=params, headers=headers) as resp:
+                    await resp.read()
+                    return resp
+            except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError):
+                if attempt == retries:
+                    raise
+            # the backoff of the requests session's Retry with backoff_factor=0.5
+            await asyncio.sleep(0.5 * 2 ** attempt)
+
+    @classmethod
+    async def request(cls, url, params=None, headers=None) -> Tuple[int, Any, Optional[str]]:
+        """ Authenticated, rate limited Web API request retried like ZSpotify.request, returns (status, json, etag) """
+        max_retries = ZSpotify.get_config(API_MAX_RETRIES)
+        for attempt in range(max_retries + 1):
+            delay = ZSpotify.get_rate_limiter().reserve()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            # tokens are almost always cached, a refresh briefly holds up the loop
+            request_headers = {**ZSpotify.get_auth_header(), **(headers or {})}
+            resp = await cls.get(url, params=params, headers=request_headers)
+            count('api_calls')
+            if resp.status == 401 and attempt == 0:
+                ZSpotify.clear_tokens()
+                continue
+            if resp.status != 429 and resp.status < 500:
+                data = None if resp.status == 304 else await resp.json(content_type=None)
+                return resp.status, data, resp.headers.get('ETag')
+            if attempt == max_retries:
+                resp.raise_for_status()
+            delay = ZSpotify.get_retry_delay(resp.headers.get('Retry-After', ''), attempt)
+            count('api_retries')
+            if resp.status == 429:
+                count('rate_limited')
+                ZSpotify.get_rate_limiter().block(delay)
+            else:
+                await asyncio.sleep(delay)
+        # only reached when a renewed token is refused as well
+        resp.raise_for_status()
+
+    @classmethod
+    async def invoke_cached(cls, url, params, cache_kind, cache_key=None):
+        """ Returns the json response of url, served from the metadata cache while fresh """
+        cache = ZSpotify.get_metadata_cache()
+        if cache is None:
+            return (await cls.request(url, params=params))[1]
+        cache_key = ZSpotify.get_cache_key(url, params, cache_key)
+
+        entry = cache.get(cache_kind, cache_key)
+        headers = None
+        if entry is not None:
+            value, etag, fetched_at = entry
+            if ZSpotify.is_fresh(cache_kind, fetched_at):
+                count('cache_hits')
+                return value
+            if etag:
+                headers = {'If-None-Match': etag}
+        status, data, etag = await cls.request(url, params=params, headers=headers)
+        if status == 304:
+            count('cache_revalidated')
+            cache.touch(cache_kind, cache_key)
+            return entry[0]
+        count('cache_misses')
+        if status < 400:
+            cache.put(cache_kind, cache_key, data, etag)
+        return data
+
+    @classmethod
+    async def invoke_url_with_params(cls, url, limit, offset, cache_kind=None, cache_key=None, **kwargs):
+        params = {LIMIT: limit, OFFSET: offset}
+        params.update(kwargs)
+        if cache_kind:
+            return await cls.invoke_cached(url, params, cache_kind, cache_key)
+        return (await cls.request(url, params=params))[1]
+
+    @classmethod
+    async def invoke_url(cls, url, cache_kind=None, cache_key=None):
+        if cache_kind:
+            return await cls.invoke_cached(url, None, cache_kind, cache_key)
+        return (await cls.request(url))[1]
+
+    @classmethod
+    async def invoke_urls(cls, urls, cache_kind=None) -> list:
+        """ Returns the json responses of urls, all requested at once """
+        return list(await asyncio.gather(*(cls.invoke_url(url, cache_kind) for url in urls)))
+
+    @classmethod
+    async def invoke_pages(cls, url, limit, offsets, cache_kind=None, cache_key=None, **kwargs) -> list:
+        """ Returns the pages of a listing starting at each offset, all requested at once """
+        return list(await asyncio.gather(*(
+            cls.invoke_url_with_params(url, limit, offset, cache_kind=cache_kind, cache_key=cache_key, **kwargs)
+            for offset in offsets)))
+
+
+def invoke_urls(urls: List[str], cache_kind=None) -> list:
+    """ Returns the json responses of urls, requested concurrently """
+    if not urls:
+        return []
+    return AsyncZSpotify.run(AsyncZSpotify.invoke_urls(urls, cache_kind)).result()
+
+
+class PagedItems:
+    """ Iterator over the items of every page, whose length hint is the total announced by the first page """
+
+    def __init__(self, items: Iterator[Any], total: int):
+        self.items = items
+        self.total = total
+
+    def __iter__(self) -> 'PagedItems':
+        return self
+
+    def __next__(self) -> Any:
+        return next(self.items)
+
+    def __length_hint__(self) -> int:
+        return self.total
+
+
+def iter_url_paginated(url, limit, cache_kind=None, cache_key=None, **kwargs) -> PagedItems:
+    """ Returns the items of every page in order, requesting the first page right away and the ones after it
+    concurrently API_PAGINATION_WORKERS at a time, the next batch while the current one is consumed """
+    resp = ZSpotify.invoke_url_with_params(url, limit, 0, cache_kind=cache_kind, cache_key=cache_key, **kwargs)
+    total = resp.get(TOTAL, len(resp[ITEMS]))
+
+    def iter_items() -> Iterator[Any]:
+        yield from resp[ITEMS]
+
+        # the first page tells how many items there are, so the remaining offsets are known up front
+        offsets = range(limit, total, limit)
+        workers = ZSpotify.get_config(API_PAGINATION_WORKERS)
+        batches = [offsets[i:i + workers] for i in range(0, len(offsets), workers)]
+
+        def get_pages(batch) -> Future:
+            return AsyncZSpotify.run(AsyncZSpotify.invoke_pages(url, limit, batch, cache_kind=cache_kind,
+                                                                cache_key=cache_key, **kwargs))
+
+        pending = get_pages(batches[0]) if batches else None
+        for i in range(len(batches)):
+            pages = pending.result()
+            if i + 1 < len(batches):
+                pending = get_pages(batches[i + 1])
+            for page in pages:
+                yield from page[ITEMS]
+    return PagedItems(iter_items(), total)
+
+
+def invoke_url_paginated(url, limit, cache_kind=None, cache_key=None, **kwargs) -> list:
+    """ Returns the items of every page """
+    return list(iter_url_paginated(url, limit, cache_kind=cache_kind, cache_key=cache_key, **kwargs))
@@ -0,0 +1,37 @@
+import json
+import sqlite3
+import threading
+import time
+from typing import Any, Optional, Tuple
+
+
+class MetadataCache:
+    """ Stores Web API responses on disk, keyed by object type and url """
+
+    def __init__(self, path: str):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS metadata ('
+                            'kind TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, etag TEXT, '
+                            'fetched_at REAL NOT NULL, PRIMARY KEY (kind, key))')
+
+    def get(self, kind: str, key: str) -> Optional[Tuple[Any, Optional[str], float]]:
+        """ Returns (value, etag, fetched_at) or None if nothing is stored """
+        with self.lock:
+            row = self.db.execute('SELECT value, etag, fetched_at FROM metadata WHERE kind = ? AND key = ?',
+                                  (kind, key)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1], row[2]
+
+    def put(self, kind: str, key: str, value: Any, etag: Optional[str] = None) -> None:
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO metadata (kind, key, value, etag, fetched_at) '
+                            'VALUES (?, ?, ?, ?, ?)', (kind, key, json.dumps(value), etag, time.time()))
+
+    def touch(self, kind: str, key: str) -> None:
+        """ Marks an entry as fresh again after the server confirmed it is unchanged """
+        with self.lock, self.db:
+            self.db.execute('UPDATE metadata SET fetched_at = ? WHERE kind = ? AND key = ?',
+                            (time.time(), kind, key))
@@ -4,6 +4,17 @@ TRACKS_URL = 'https://api.spotify.com/v1/tracks'
 
 TRACK_STATS_URL = 'https://api.spotify.com/v1/audio-features/'
 
+TRACKS_PER_REQUEST = 50
+
+ALBUMS_PER_REQUEST = 20
+
+# bounds of the adaptive read size of copy_stream and the time it aims to spend per read
+MIN_CHUNK_SIZE = 4096
+
+MAX_CHUNK_SIZE = 1048576
+
+CHUNK_READ_TIME = 0.05
+
 TRACKNUMBER = 'tracknumber'
 
 DISCNUMBER = 'discnumber'
@@ -28,6 +39,8 @@ TRACK = 'track'
 
 ITEMS = 'items'
 
+TOTAL = 'total'
+
 NAME = 'name'
 
 ID = 'id'
@@ -62,6 +75,10 @@ PLAYLIST = 'playlist'
 
 PLAYLISTS = 'playlists'
 
+PLAYLIST_TRACKS = 'playlist_tracks'
+
+SNAPSHOT_ID = 'snapshot_id'
+
 OWNER = 'owner'
 
 DISPLAY_NAME = 'display_name'
@@ -78,12 +95,25 @@ PLAYLIST_READ_PRIVATE = 'playlist-read-private'
 
 USER_LIBRARY_READ = 'user-library-read'
 
+TOKEN_EXPIRY_MARGIN = 60
+
 WINDOWS_SYSTEM = 'Windows'
 
 CREDENTIALS_JSON = 'credentials.json'
 
 CONFIG_FILE_PATH = '../zs_config.json'
 
+METADATA_CACHE_FILE_PATH = '../zs_metadata.db'
+
+ARTWORK_CACHE_DIR_PATH = '../zs_artwork'
+
+JOURNAL_FILE_PATH = '../zs_journal.jsonl'
+
+SCRATCH_DIR_PATH = '../zs_scratch'
+
+# seconds after which a file nobody journaled counts as left behind in the scratch directory
+SCRATCH_STALE_AGE = 3600
+
 ROOT_PATH = 'ROOT_PATH'
 
 ROOT_PODCAST_PATH = 'ROOT_PODCAST_PATH'
@@ -94,10 +124,6 @@ DOWNLOAD_FORMAT = 'DOWNLOAD_FORMAT'
 
 FORCE_PREMIUM = 'FORCE_PREMIUM'
 
-ANTI_BAN_WAIT_TIME = 'ANTI_BAN_WAIT_TIME'
-
-OVERRIDE_AUTO_WAIT = 'OVERRIDE_AUTO_WAIT'
-
 CHUNK_SIZE = 'CHUNK_SIZE'
 
 SPLIT_ALBUM_DISCS = 'SPLIT_ALBUM_DISCS'
@@ -106,6 +132,56 @@ DOWNLOAD_REAL_TIME = 'DOWNLOAD_REAL_TIME'
 
 BITRATE = 'BITRATE'
 
+DOWNLOAD_WORKERS = 'DOWNLOAD_WORKERS'
+
+HTTP_POOL_SIZE = 'HTTP_POOL_SIZE'
+
+HTTP_TIMEOUT = 'HTTP_TIMEOUT'
+
+HTTP_RETRIES = 'HTTP_RETRIES'
+
+API_RATE_LIMIT = 'API_RATE_LIMIT'
+
+API_RATE_BURST = 'API_RATE_BURST'
+
+API_MAX_RETRIES = 'API_MAX_RETRIES'
+
+API_MAX_BACKOFF = 60
+
+API_PAGINATION_WORKERS = 'API_PAGINATION_WORKERS'
+
+METADATA_CACHE = 'METADATA_CACHE'
+
+METADATA_CACHE_TTL = 'METADATA_CACHE_TTL'
+
+DEDUPLICATE = 'DEDUPLICATE'
+
+TRANSCODE_STREAMING = 'TRANSCODE_STREAMING'
+
+TRANSCODE_WORKERS = 'TRANSCODE_WORKERS'
+
+SCRATCH_PATH = 'SCRATCH_PATH'
+
+STAGE_IN_MEMORY = 'STAGE_IN_MEMORY'
+
+STAGING_MEMORY_LIMIT = 'STAGING_MEMORY_LIMIT'
+
+ARTWORK_CACHE = 'ARTWORK_CACHE'
+
+ARTWORK_CACHE_ENTRIES = 'ARTWORK_CACHE_ENTRIES'
+
+ARTWORK_MAX_SIZE = 'ARTWORK_MAX_SIZE'
+
+ARTWORK_QUALITY = 'ARTWORK_QUALITY'
+
+SYNC_REMOVE_DELETED = 'SYNC_REMOVE_DELETED'
+
+METRICS_PORT = 'METRICS_PORT'
+
+METRICS_TEXTFILE = 'METRICS_TEXTFILE'
+
+METRICS_INTERVAL = 'METRICS_INTERVAL'
+
 CODEC_MAP = {
     'aac': 'aac',
     'fdk_aac': 'libfdk_aac',
@@ -132,10 +208,38 @@ CONFIG_DEFAULT_SETTINGS = {
     'SKIP_EXISTING_FILES': True,
     'DOWNLOAD_FORMAT': 'ogg',
     'FORCE_PREMIUM': False,
-    'ANTI_BAN_WAIT_TIME': 1,
-    'OVERRIDE_AUTO_WAIT': False,
     'CHUNK_SIZE': 32768,
     'SPLIT_ALBUM_DISCS': False,
     'DOWNLOAD_REAL_TIME': False,
-    'LANGUAGE': 'en'
+    'LANGUAGE': 'en',
+    'DOWNLOAD_WORKERS': 4,
+    'HTTP_POOL_SIZE': 16,
+    'HTTP_TIMEOUT': 30,
+    'HTTP_RETRIES': 3,
+    'API_RATE_LIMIT': 10,
+    'API_RATE_BURST': 20,
+    'API_MAX_RETRIES': 5,
+    'API_PAGINATION_WORKERS': 8,
+    'METADATA_CACHE': True,
+    'METADATA_CACHE_TTL': {
+        'track': 604800,
+        'album': 2592000,
+        'artist': 86400,
+        'playlist': 0,
+        'playlist_tracks': 2592000
+    },
+    'DEDUPLICATE': 'none',
+    'TRANSCODE_STREAMING': False,
+    'TRANSCODE_WORKERS': 0,
+    'SCRATCH_PATH': '',
+    'STAGE_IN_MEMORY': False,
+    'STAGING_MEMORY_LIMIT': 268435456,
+    'ARTWORK_CACHE': True,
+    'ARTWORK_CACHE_ENTRIES': 64,
+    'ARTWORK_MAX_SIZE': 0,
+    'ARTWORK_QUALITY': 90,
+    'SYNC_REMOVE_DELETED': False,
+    'METRICS_PORT': 0,
+    'METRICS_TEXTFILE': '',
+    'METRICS_INTERVAL': 15
 }
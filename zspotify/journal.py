@@ -0,0 +1,97 @@
+import json
+import os
+import threading
+from typing import Dict, Optional, Set, Tuple
+
+from const import JOURNAL_FILE_PATH
+
+JOURNAL = None
+JOURNAL_LOCK = threading.Lock()
+
+
+class DownloadJournal:
+    """ Append-only log of the songs finished by each batch job and of partially downloaded files """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.done: Dict[str, Set[str]] = {}
+        self.partial: Dict[str, Tuple[str, int]] = {}
+
+        if os.path.isfile(path):
+            with open(path, encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        self.apply(json.loads(line))
+                    except ValueError:
+                        # the last line may be cut short by a crash
+                        continue
+        self.compact()
+
+    def apply(self, entry: dict) -> None:
+        if 'reset' in entry:
+            self.done[entry['reset']] = set()
+        elif 'done' in entry:
+            self.done.setdefault(entry['job'], set()).add(entry['done'])
+        elif 'partial' in entry:
+            if entry['path']:
+                self.partial[entry['partial']] = (entry['path'], entry['offset'])
+            else:
+                self.partial.pop(entry['partial'], None)
+
+    def compact(self) -> None:
+        """ Rewrites the log with only the entries still in effect """
+        temp_path = f'{self.path}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            for job, track_ids in self.done.items():
+                file.write(json.dumps({'reset': job}) + '\n')
+                for track_id in track_ids:
+                    file.write(json.dumps({'job': job, 'done': track_id}) + '\n')
+            # .part files that are gone can no longer be resumed
+            self.partial = {track_id: entry for track_id, entry in self.partial.items() if os.path.isfile(entry[0])}
+            for track_id, (path, offset) in self.partial.items():
+                file.write(json.dumps({'partial': track_id, 'path': path, 'offset': offset}) + '\n')
+        os.replace(temp_path, self.path)
+
+    def write(self, entry: dict) -> None:
+        with self.lock:
+            self.apply(entry)
+            with open(self.path, 'a', encoding='utf-8') as file:
+                file.write(json.dumps(entry) + '\n')
+
+    def start_job(self, job: str, resume: bool) -> Set[str]:
+        """ Returns the songs a job already finished, forgetting them first unless resuming """
+        if not resume:
+            self.write({'reset': job})
+        with self.lock:
+            return set(self.done.get(job, ()))
+
+    def mark_done(self, job: str, track_id: str) -> None:
+        self.write({'job': job, 'done': track_id})
+
+    def get_partial(self, track_id: str) -> Optional[Tuple[str, int]]:
+        """ Returns (path, offset) of a partially downloaded song """
+        with self.lock:
+            return self.partial.get(track_id)
+
+    def set_partial(self, track_id: str, path: str, offset: int) -> None:
+        """ Records that a song is being downloaded to path, with at least offset bytes written """
+        self.write({'partial': track_id, 'path': path, 'offset': offset})
+
+    def get_partial_paths(self) -> Set[str]:
+        """ Returns the paths of every partially downloaded file """
+        with self.lock:
+            return {path for path, _ in self.partial.values()}
+
+    def clear_partial(self, track_id: str) -> None:
+        """ Forgets the partially downloaded file of a song """
+        self.write({'partial': track_id, 'path': None, 'offset': 0})
+
+
+def get_journal() -> DownloadJournal:
+    """ Returns the download journal stored next to the config, loading it on first use """
+    global JOURNAL
+    with JOURNAL_LOCK:
+        if JOURNAL is None:
+            JOURNAL = DownloadJournal(os.path.join(os.path.dirname(__file__), JOURNAL_FILE_PATH))
+        return JOURNAL
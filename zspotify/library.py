@@ -0,0 +1,205 @@
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows
+    fcntl = None
+
+from const import ROOT_PATH
+from utils import get_directory_song_ids
+from zspotify import ZSpotify
+
+LIBRARY_INDEX_FILE = '.library.db'
+# ioctl request number of FICLONE on Linux
+FICLONE = 0x40049409
+LIBRARY_INDEX = None
+LIBRARY_INDEX_LOCK = threading.Lock()
+
+
+def get_file_checksum(filename: str) -> str:
+    """ Returns the sha1 hex digest of a file """
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def reflink_file(src: str, dst: str) -> None:
+    """ Copies a file by sharing its blocks on filesystems that support it, copying the data otherwise """
+    if fcntl is None:
+        shutil.copyfile(src, dst)
+        return
+    try:
+        with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def link_file(src: str, dst: str, mode: str) -> None:
+    """ Makes dst a hardlink, symlink, reflink or plain copy of src """
+    directory = os.path.dirname(os.path.abspath(dst))
+    os.makedirs(directory, exist_ok=True)
+    # the link is made under a temporary name and renamed over dst, so dst is never missing or half written
+    temp_dst = os.path.join(directory, f'.{os.path.basename(dst)}.{os.getpid()}.{threading.get_ident()}.tmp')
+    try:
+        try:
+            if mode == 'hardlink':
+                os.link(src, temp_dst)
+            elif mode == 'symlink':
+                os.symlink(os.path.relpath(os.path.realpath(src), directory), temp_dst)
+            elif mode == 'reflink':
+                reflink_file(src, temp_dst)
+            else:
+                shutil.copyfile(src, temp_dst)
+        except OSError:
+            # e.g. hardlinks across filesystems or symlinks without the privilege on Windows
+            if os.path.lexists(temp_dst):
+                os.remove(temp_dst)
+            shutil.copyfile(src, temp_dst)
+        os.replace(temp_dst, dst)
+    except BaseException:
+        if os.path.lexists(temp_dst):
+            os.remove(temp_dst)
+        raise
+
+
+def is_same_file(path: str, other: str) -> bool:
+    """ Returns whether two paths name the same file, following links """
+    if os.path.normcase(os.path.abspath(path)) == os.path.normcase(os.path.abspath(other)):
+        return True
+    try:
+        return os.path.samefile(path, other)
+    except OSError:
+        return False
+
+
+class LibraryIndex:
+    """ Index of every song downloaded below ROOT_PATH, kept in memory for O(1) lookups """
+
+    def __init__(self, root_path: str):
+        self.root_path = os.path.normpath(os.path.abspath(root_path))
+        self.lock = threading.Lock()
+        # track id -> {relative path: (size, format, checksum)}
+        self.songs: Dict[str, Dict[str, Tuple[int, str, str]]] = {}
+        # relative path -> track id
+        self.paths: Dict[str, str] = {}
+        # (relative directory, track id) of songs listed in old per-directory .song_ids files
+        self.legacy_ids = set()
+
+        os.makedirs(self.root_path, exist_ok=True)
+        index_path = os.path.join(self.root_path, LIBRARY_INDEX_FILE)
+        is_new = not os.path.isfile(index_path)
+        self.db = sqlite3.connect(index_path, check_same_thread=False)
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS songs (path TEXT PRIMARY KEY, track_id TEXT NOT NULL, '
+                            'size INTEGER NOT NULL, format TEXT NOT NULL, checksum TEXT NOT NULL)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS songs_track_id ON songs (track_id)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS legacy_ids (directory TEXT NOT NULL, track_id TEXT NOT NULL, '
+                            'PRIMARY KEY (directory, track_id))')
+            self.db.execute('CREATE TABLE IF NOT EXISTS playlists (playlist_id TEXT PRIMARY KEY, snapshot_id TEXT, '
+                            'track_ids TEXT NOT NULL)')
+        if is_new:
+            self.import_song_ids_files()
+
+        for path, track_id, size, file_format, checksum in self.db.execute('SELECT * FROM songs'):
+            self.songs.setdefault(track_id, {})[path] = (size, file_format, checksum)
+            self.paths[path] = track_id
+        self.legacy_ids.update(self.db.execute('SELECT directory, track_id FROM legacy_ids'))
+
+    def relative_path(self, path: str) -> str:
+        return os.path.relpath(os.path.normpath(os.path.abspath(path)), self.root_path)
+
+    def import_song_ids_files(self) -> None:
+        """ Carries over the song ids of .song_ids files written by older versions """
+        with self.db:
+            for directory, _, files in os.walk(self.root_path):
+                if '.song_ids' in files:
+                    relative_directory = self.relative_path(directory)
+                    self.db.executemany('INSERT OR IGNORE INTO legacy_ids VALUES (?, ?)',
+                                        [(relative_directory, song_id)
+                                         for song_id in get_directory_song_ids(directory) if song_id])
+
+    def find(self, track_id: str) -> List[Tuple[str, int, str, str]]:
+        """ Returns (absolute path, size, format, checksum) of every indexed copy of a song """
+        with self.lock:
+            return [(os.path.join(self.root_path, path), *entry) for path, entry in self.songs.get(track_id, {}).items()]
+
+    def has_song(self, track_id: str, directory: str) -> bool:
+        """ Returns whether a song was downloaded into the given directory """
+        relative_directory = self.relative_path(directory)
+        with self.lock:
+            if (relative_directory, track_id) in self.legacy_ids:
+                return True
+            return any((os.path.dirname(path) or os.curdir) == relative_directory
+                       for path in self.songs.get(track_id, {}))
+
+    def link_existing_copy(self, track_id: str, filename: str, file_format: str, mode: str) -> bool:
+        """ Materialises an intact indexed copy of a song at filename, returns False if there is none """
+        for path, size, copy_format, checksum in self.find(track_id):
+            # the copy at filename itself would be deleted by linking it over itself
+            if is_same_file(path, filename):
+                continue
+            if copy_format == file_format and os.path.isfile(path) and os.path.getsize(path) == size:
+                link_file(path, filename, mode)
+                self.add(track_id, filename, file_format, checksum)
+                return True
+        return False
+
+    def add(self, track_id: str, filename: str, file_format: str, checksum: Optional[str] = None) -> None:
+        """ Records a downloaded song, replacing whatever was indexed at the same path """
+        path = self.relative_path(filename)
+        entry = (os.path.getsize(filename), file_format, checksum or get_file_checksum(filename))
+        with self.lock, self.db:
+            if path in self.paths:
+                self.songs[self.paths[path]].pop(path, None)
+            self.songs.setdefault(track_id, {})[path] = entry
+            self.paths[path] = track_id
+            self.db.execute('INSERT OR REPLACE INTO songs VALUES (?, ?, ?, ?, ?)', (path, track_id, *entry))
+
+    def remove(self, track_id: str, directory: str) -> None:
+        """ Deletes the files of a song below directory and forgets them """
+        relative_directory = self.relative_path(directory)
+        with self.lock, self.db:
+            paths = [path for path in self.songs.get(track_id, {})
+                     if relative_directory == os.curdir or path.startswith(relative_directory + os.sep)]
+            for path in paths:
+                absolute_path = os.path.join(self.root_path, path)
+                if os.path.lexists(absolute_path):
+                    os.remove(absolute_path)
+                del self.songs[track_id][path]
+                del self.paths[path]
+                self.db.execute('DELETE FROM songs WHERE path = ?', (path,))
+            self.legacy_ids.discard((relative_directory, track_id))
+            self.db.execute('DELETE FROM legacy_ids WHERE directory = ? AND track_id = ?', (relative_directory, track_id))
+
+    def get_playlist_state(self, playlist_id: str) -> Tuple[Optional[str], Set[str]]:
+        """ Returns the snapshot id and songs of a playlist when it was last synced """
+        with self.lock:
+            row = self.db.execute('SELECT snapshot_id, track_ids FROM playlists WHERE playlist_id = ?',
+                                  (playlist_id,)).fetchone()
+        if row is None:
+            return None, set()
+        return row[0], set(json.loads(row[1]))
+
+    def set_playlist_state(self, playlist_id: str, snapshot_id: Optional[str], track_ids: Iterable[str]) -> None:
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO playlists VALUES (?, ?, ?)',
+                            (playlist_id, snapshot_id, json.dumps(sorted(track_ids))))
+
+
+def get_library_index() -> LibraryIndex:
+    """ Returns the index of the library in ROOT_PATH, loading it on first use """
+    global LIBRARY_INDEX
+    with LIBRARY_INDEX_LOCK:
+        if LIBRARY_INDEX is None:
+            LIBRARY_INDEX = LibraryIndex(os.path.join(os.path.dirname(__file__), ZSpotify.get_config(ROOT_PATH)))
+        return LIBRARY_INDEX
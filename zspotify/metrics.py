@@ -0,0 +1,113 @@
+import atexit
+import os
+import threading
+import time
+from bisect import bisect_right
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from const import METRICS_PORT, METRICS_TEXTFILE, METRICS_INTERVAL
+from stats import get_stats
+from zspotify import ZSpotify
+
+PREFIX = 'zspotify'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# seconds, from a cached metadata lookup to a long ffmpeg run
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+COUNTER_HELP = {
+    'api_calls': 'Spotify Web API requests sent',
+    'api_retries': 'Spotify Web API requests retried after a 429 or 5xx response',
+    'rate_limited': 'Spotify Web API requests answered with 429 Too Many Requests',
+    'cache_hits': 'Metadata served from the metadata cache',
+    'cache_misses': 'Metadata not found in the metadata cache',
+    'cache_revalidated': 'Expired metadata confirmed unchanged by Spotify',
+    'bytes': 'Bytes of audio downloaded',
+}
+GAUGE_HELP = {
+    'queued_downloads': 'Songs waiting for a download worker',
+    'active_downloads': 'Songs being downloaded',
+    'queued_transcodes': 'Downloaded songs waiting for a transcoding worker',
+    'active_transcodes': 'Songs being converted, tagged and indexed',
+}
+
+
+def format_value(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render_metrics() -> str:
+    """ Returns the stats of the run in the Prometheus text exposition format """
+    run = get_stats()
+    statuses, counters, samples = run.snapshot()
+    elapsed = time.perf_counter() - run.started
+    lines = [f'# HELP {PREFIX}_tracks_total Songs processed by outcome',
+             f'# TYPE {PREFIX}_tracks_total counter']
+    lines += [f'{PREFIX}_tracks_total{{status="{status}"}} {number}' for status, number in sorted(statuses.items())]
+
+    for name, value in sorted(counters.items()):
+        lines += [f'# HELP {PREFIX}_{name}_total {COUNTER_HELP.get(name, name.replace("_", " "))}',
+                  f'# TYPE {PREFIX}_{name}_total counter',
+                  f'{PREFIX}_{name}_total {format_value(value)}']
+
+    lines += [f'# HELP {PREFIX}_bytes_per_second Average download speed since the start of the run',
+              f'# TYPE {PREFIX}_bytes_per_second gauge',
+              f'{PREFIX}_bytes_per_second {format_value(counters["bytes"] / elapsed if elapsed else 0.0)}']
+    for name, value in sorted(run.get_gauges().items()):
+        lines += [f'# HELP {PREFIX}_{name} {GAUGE_HELP.get(name, name.replace("_", " "))}',
+                  f'# TYPE {PREFIX}_{name} gauge',
+                  f'{PREFIX}_{name} {value}']
+
+    lines += [f'# HELP {PREFIX}_stage_seconds Time spent in each stage, per song or per request',
+              f'# TYPE {PREFIX}_stage_seconds histogram']
+    for name, values in sorted(samples.items()):
+        for bound in BUCKETS:
+            lines.append(f'{PREFIX}_stage_seconds_bucket{{stage="{name}",le="{bound}"}} {bisect_right(values, bound)}')
+        lines += [f'{PREFIX}_stage_seconds_bucket{{stage="{name}",le="+Inf"}} {len(values)}',
+                  f'{PREFIX}_stage_seconds_sum{{stage="{name}"}} {format_value(float(sum(values)))}',
+                  f'{PREFIX}_stage_seconds_count{{stage="{name}"}} {len(values)}']
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = render_metrics().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def write_textfile(path: str) -> None:
+    """ Writes the metrics for node_exporter's textfile collector, replacing the file in one step """
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as file:
+        file.write(render_metrics())
+    os.replace(temp_path, path)
+
+
+def start_metrics() -> None:
+    """ Serves metrics on METRICS_PORT and writes them to METRICS_TEXTFILE every METRICS_INTERVAL seconds,
+    whichever is configured """
+    port = ZSpotify.get_config(METRICS_PORT)
+    if port:
+        server = ThreadingHTTPServer(('', port), MetricsHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='zspotify-metrics', daemon=True).start()
+
+    path = ZSpotify.get_config(METRICS_TEXTFILE)
+    if path:
+        interval = ZSpotify.get_config(METRICS_INTERVAL)
+
+        def write_periodically():
+            while True:
+                time.sleep(interval)
+                write_textfile(path)
+        threading.Thread(target=write_periodically, name='zspotify-metrics', daemon=True).start()
+        # the last state of the run stays readable after it ends
+        atexit.register(write_textfile, path)
@@ -1,7 +1,10 @@
-from tqdm import tqdm
+import os
+from operator import length_hint
 
-from const import ITEMS, ID, TRACK, NAME
-from track import download_track
+from const import ID, TRACK, NAME, PLAYLIST, PLAYLIST_TRACKS, SNAPSHOT_ID, ROOT_PATH, SYNC_REMOVE_DELETED
+from asyncapi import iter_url_paginated
+from library import get_library_index
+from track import download_tracks
 from utils import fix_filename
 from zspotify import ZSpotify
 
@@ -9,55 +12,77 @@ MY_PLAYLISTS_URL = 'https://api.spotify.com/v1/me/playlists'
 PLAYLISTS_URL = 'https://api.spotify.com/v1/playlists'
 
 
+def iter_all_playlists():
+    """ Yields users playlists page by page """
+    return iter_url_paginated(MY_PLAYLISTS_URL, limit=50, cache_kind=PLAYLIST)
+
+
 def get_all_playlists():
     """ Returns list of users playlists """
-    playlists = []
-    limit = 50
-    offset = 0
+    return list(iter_all_playlists())
 
-    while True:
-        resp = ZSpotify.invoke_url_with_params(MY_PLAYLISTS_URL, limit=limit, offset=offset)
-        offset += limit
-        playlists.extend(resp[ITEMS])
-        if len(resp[ITEMS]) < limit:
-            break
 
-    return playlists
+def get_playlist_snapshot_id(playlist_id):
+    """ Returns the id of the playlist's current version """
+    resp = ZSpotify.invoke_url(f'{PLAYLISTS_URL}/{playlist_id}?fields=snapshot_id', cache_kind=PLAYLIST)
+    return resp[SNAPSHOT_ID]
 
 
-def get_playlist_songs(playlist_id):
-    """ returns list of songs in a playlist """
-    songs = []
-    offset = 0
-    limit = 100
+def iter_playlist_songs(playlist_id, snapshot_id=None):
+    """ Yields songs in a playlist page by page """
+    # pages of a playlist version never change, so they are cached by snapshot id
+    if snapshot_id is None and ZSpotify.get_metadata_cache():
+        snapshot_id = get_playlist_snapshot_id(playlist_id)
 
-    while True:
-        resp = ZSpotify.invoke_url_with_params(f'{PLAYLISTS_URL}/{playlist_id}/tracks', limit=limit, offset=offset)
-        offset += limit
-        songs.extend(resp[ITEMS])
-        if len(resp[ITEMS]) < limit:
-            break
+    url = f'{PLAYLISTS_URL}/{playlist_id}/tracks'
+    if snapshot_id:
+        return iter_url_paginated(url, limit=100, cache_kind=PLAYLIST_TRACKS,
+                                  cache_key=f'{url}@{snapshot_id}')
+    return iter_url_paginated(url, limit=100)
 
-    return songs
+
+def get_playlist_songs(playlist_id, snapshot_id=None):
+    """ returns list of songs in a playlist """
+    return list(iter_playlist_songs(playlist_id, snapshot_id))
 
 
 def get_playlist_info(playlist_id):
     """ Returns information scraped from playlist """
-    resp = ZSpotify.invoke_url(f'{PLAYLISTS_URL}/{playlist_id}?fields=name,owner(display_name)&market=from_token')
+    resp = ZSpotify.invoke_url(f'{PLAYLISTS_URL}/{playlist_id}?fields=name,owner(display_name)&market=from_token',
+                               cache_kind=PLAYLIST)
     return resp['name'].strip(), resp['owner']['display_name'].strip()
 
 
-def download_playlist(playlist):
-    """Downloads all the songs from a playlist"""
-
-    playlist_songs = [song for song in get_playlist_songs(playlist[ID]) if song[TRACK][ID]]
-    p_bar = tqdm(playlist_songs, unit='song', total=len(playlist_songs), unit_scale=True)
-    enum = 1
-    for song in p_bar:
-        download_track(song[TRACK][ID], fix_filename(playlist[NAME].strip()) + '/',
-                       prefix=True, prefix_value=str(enum) ,disable_progressbar=True)
-        p_bar.set_description(song[TRACK][NAME])
-        enum += 1
+def download_playlist(playlist, prefix=True):
+    """Downloads all the songs from a playlist, in sync mode only the ones added since the last download"""
+    library = get_library_index()
+    extra_paths = fix_filename(playlist[NAME].strip()) + '/'
+    snapshot_id = playlist.get(SNAPSHOT_ID) or get_playlist_snapshot_id(playlist[ID])
+    synced_snapshot_id, synced_ids = library.get_playlist_state(playlist[ID])
+    if ZSpotify.SYNC and synced_snapshot_id == snapshot_id:
+        print(f'###   SKIPPING: {playlist[NAME].strip()} (PLAYLIST UNCHANGED)   ###')
+        return
+
+    playlist_ids = []
+    songs = iter_playlist_songs(playlist[ID], snapshot_id)
+
+    def playlist_songs():
+        for song in songs:
+            if song[TRACK][ID]:
+                playlist_ids.append(song[TRACK][ID])
+                yield song[TRACK][ID]
+
+    done_ids = download_tracks(playlist_songs(), extra_paths, prefix=prefix, desc=playlist[NAME].strip(),
+                               total=length_hint(songs), skip_ids=synced_ids if ZSpotify.SYNC else None)
+
+    if ZSpotify.SYNC and ZSpotify.get_config(SYNC_REMOVE_DELETED):
+        playlist_directory = os.path.join(os.path.dirname(__file__), ZSpotify.get_config(ROOT_PATH), extra_paths)
+        for track_id in synced_ids.difference(playlist_ids):
+            library.remove(track_id, playlist_directory)
+
+    # the snapshot only counts as synced once every song of it is in place
+    library.set_playlist_state(playlist[ID], snapshot_id if done_ids.issuperset(playlist_ids) else None,
+                               done_ids.intersection(playlist_ids))
 
 
 def download_from_user_playlist():
@@ -1,13 +1,14 @@
 import os
-from typing import Optional, Tuple
+from typing import Iterator, Optional, Tuple
 
 from librespot.audio.decoders import VorbisOnlyAudioQuality
 from librespot.metadata import EpisodeId
 from tqdm import tqdm
 
-from const import (CHUNK_SIZE, ERROR, ID, ITEMS, NAME, ROOT_PODCAST_PATH, SHOW,
+from const import (CHUNK_SIZE, ERROR, ID, NAME, ROOT_PODCAST_PATH, SHOW,
                    SKIP_EXISTING_FILES)
-from utils import create_download_directory, fix_filename
+from asyncapi import iter_url_paginated
+from utils import copy_stream, create_download_directory, fix_filename
 from zspotify import ZSpotify
 
 EPISODE_INFO_URL = 'https://api.spotify.com/v1/episodes'
@@ -21,31 +22,20 @@ def get_episode_info(episode_id_str) -> Tuple[Optional[str], Optional[str]]:
     return fix_filename(info[SHOW][NAME]), fix_filename(info[NAME])
 
 
-def get_show_episodes(show_id_str) -> list:
-    episodes = []
-    offset = 0
-    limit = 50
+def iter_show_episodes(show_id_str) -> Iterator[str]:
+    episodes = iter_url_paginated(f'{SHOWS_URL}/{show_id_str}/episodes', limit=50)
+    return (episode[ID] for episode in episodes)
 
-    while True:
-        resp = ZSpotify.invoke_url_with_params(
-            f'{SHOWS_URL}/{show_id_str}/episodes', limit=limit, offset=offset)
-        offset += limit
-        for episode in resp[ITEMS]:
-            episodes.append(episode[ID])
-        if len(resp[ITEMS]) < limit:
-            break
 
-    return episodes
+def get_show_episodes(show_id_str) -> list:
+    return list(iter_show_episodes(show_id_str))
 
 
 def download_podcast_directly(url, filename):
     import functools
     import pathlib
-    import shutil
-    import requests
-    from tqdm.auto import tqdm
 
-    r = requests.get(url, stream=True, allow_redirects=True)
+    r = ZSpotify.http_get(url, stream=True, allow_redirects=True)
     if r.status_code != 200:
         r.raise_for_status()  # Will only raise for 4xx codes, so...
         raise RuntimeError(
@@ -58,9 +48,9 @@ def download_podcast_directly(url, filename):
     desc = "(Unknown total file size)" if file_size == 0 else ""
     r.raw.read = functools.partial(
         r.raw.read, decode_content=True)  # Decompress if needed
-    with tqdm.wrapattr(r.raw, "read", total=file_size, desc=desc) as r_raw:
+    with tqdm(total=file_size, desc=desc, unit='B', unit_scale=True, unit_divisor=1024) as bar:
         with path.open("wb") as f:
-            shutil.copyfileobj(r_raw, f)
+            copy_stream(r.raw, f, ZSpotify.get_config(CHUNK_SIZE), on_chunk=bar.update)
 
     return path
 
@@ -115,9 +105,8 @@ def download_episode(episode_id) -> None:
                 unit_scale=True,
                 unit_divisor=1024
             ) as bar:
-                for _ in range(int(total_size / ZSpotify.get_config(CHUNK_SIZE)) + 1):
-                    bar.update(file.write(
-                        stream.input_stream.stream().read(ZSpotify.get_config(CHUNK_SIZE))))
+                copy_stream(stream.input_stream.stream(), file, ZSpotify.get_config(CHUNK_SIZE),
+                            limit=total_size, on_chunk=bar.update)
         else:
             filepath = os.path.join(download_directory, f"{filename}.mp3")
             download_podcast_directly(direct_download_url, filepath)
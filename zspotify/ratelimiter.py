@@ -0,0 +1,39 @@
+import threading
+import time
+
+
+class RateLimiter:
+    """ Token bucket shared by every Web API request """
+
+    def __init__(self, rate: float, burst: int):
+        # a rate of 0 disables the bucket, pauses requested by block() still apply
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """ Takes a token and returns how many seconds the caller has to wait before using it """
+        with self.lock:
+            now = time.monotonic()
+            delay = max(0.0, self.blocked_until - now)
+            if self.rate:
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.tokens -= 1
+                if self.tokens < 0:
+                    delay = max(delay, -self.tokens / self.rate)
+            self.updated = now
+            return delay
+
+    def acquire(self) -> None:
+        """ Blocks until a request may be sent """
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    def block(self, seconds: float) -> None:
+        """ Holds back every caller for the given number of seconds, e.g. after a 429 """
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
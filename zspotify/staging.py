@@ -0,0 +1,66 @@
+import io
+import threading
+
+from const import STAGING_MEMORY_LIMIT
+from zspotify import ZSpotify
+
+MEMORY_BUDGET = None
+MEMORY_BUDGET_LOCK = threading.Lock()
+
+
+class MemoryBudget:
+    """ Bytes of audio that may be staged in memory at once, shared by every download worker """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def reserve(self, size: int) -> bool:
+        """ Takes size bytes of the budget, returns False without taking any if they are not left """
+        with self.lock:
+            if self.used + size > self.limit:
+                return False
+            self.used += size
+            return True
+
+    def release(self, size: int) -> None:
+        with self.lock:
+            self.used -= size
+
+
+class StagedAudio(io.BytesIO):
+    """ Downloaded audio kept in memory instead of a .part file, counted against a memory budget """
+
+    def __init__(self, budget: MemoryBudget, size: int):
+        super().__init__()
+        self.budget = budget
+        self.size = size
+        self.released = False
+
+    def close(self) -> None:
+        # the download loop closes its file, but the data is still needed for converting or writing it out
+        pass
+
+    def release(self) -> None:
+        """ Frees the audio and gives its share of the budget back """
+        if not self.released:
+            self.released = True
+            super().close()
+            self.budget.release(self.size)
+
+
+def get_memory_budget() -> MemoryBudget:
+    global MEMORY_BUDGET
+    with MEMORY_BUDGET_LOCK:
+        if MEMORY_BUDGET is None:
+            MEMORY_BUDGET = MemoryBudget(ZSpotify.get_config(STAGING_MEMORY_LIMIT))
+        return MEMORY_BUDGET
+
+
+def stage_in_memory(size: int) -> StagedAudio:
+    """ Returns an in-memory file for size bytes of audio, or None if the memory budget is used up """
+    budget = get_memory_budget()
+    if not budget.reserve(size):
+        return None
+    return StagedAudio(budget, size)
@@ -0,0 +1,208 @@
+import json
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+STATS = None
+STATS_LOCK = threading.Lock()
+# the record of the song the current thread works on
+CURRENT = threading.local()
+PERCENTILES = (('p50', 0.5), ('p90', 0.9), ('p99', 0.99))
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """ Nearest rank percentile of sorted values """
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+class TrackRecord:
+    """ Time spent in each stage of downloading one song and the counters it drove up """
+
+    def __init__(self, run: 'RunStats', track_id: str):
+        self.run = run
+        self.track_id = track_id
+        self.status = 'failed'
+        self.stages: Dict[str, float] = defaultdict(float)
+        self.counters = Counter()
+        self.started = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] += time.perf_counter() - start
+
+    def finish(self, status: Optional[str] = None) -> None:
+        if status:
+            self.status = status
+        if getattr(CURRENT, 'record', None) is self:
+            CURRENT.record = None
+        self.run.add(self)
+
+
+class RunStats:
+    """ Collects the records of every song of a run, writing each as a json line if a path is given """
+
+    def __init__(self, path: Optional[str] = None):
+        self.lock = threading.Lock()
+        self.records: List[dict] = []
+        # stages and counters of work not done for one particular song, e.g. prefetching metadata
+        self.stages: Dict[str, List[float]] = defaultdict(list)
+        self.counters = Counter()
+        # current values such as queue depths
+        self.gauges = Counter()
+        self.started = time.perf_counter()
+        self.file = open(path, 'a', encoding='utf-8') if path else None
+
+    def add(self, record: TrackRecord) -> None:
+        entry = {
+            'track_id': record.track_id,
+            'status': record.status,
+            'elapsed': time.perf_counter() - record.started,
+            'stages': dict(record.stages),
+            'counters': dict(record.counters),
+        }
+        with self.lock:
+            self.records.append(entry)
+            if self.file:
+                self.file.write(json.dumps(entry) + '\n')
+                self.file.flush()
+
+    def add_stage(self, name: str, seconds: float) -> None:
+        with self.lock:
+            self.stages[name].append(seconds)
+
+    def count(self, name: str, value=1) -> None:
+        with self.lock:
+            self.counters[name] += value
+
+    def add_gauge(self, name: str, delta: int) -> None:
+        with self.lock:
+            self.gauges[name] += delta
+
+    def get_gauges(self) -> Dict[str, int]:
+        with self.lock:
+            return dict(self.gauges)
+
+    def snapshot(self) -> Tuple[Counter, Counter, Dict[str, List[float]]]:
+        """ Returns song counts by status, counter totals and the sorted times of every stage so far """
+        with self.lock:
+            records = list(self.records)
+            samples = {name: list(values) for name, values in self.stages.items()}
+            counters = Counter(self.counters)
+
+        for record in records:
+            counters.update(record['counters'])
+            for name, seconds in record['stages'].items():
+                samples.setdefault(name, []).append(seconds)
+        samples['total'] = [record['elapsed'] for record in records]
+        for values in samples.values():
+            values.sort()
+        return Counter(record['status'] for record in records), counters, samples
+
+    def summary(self) -> dict:
+        """ Returns song counts by status, counter totals and percentiles of the time of every stage """
+        statuses, counters, samples = self.snapshot()
+        elapsed = time.perf_counter() - self.started
+
+        stages = {}
+        for name, values in samples.items():
+            if not values:
+                continue
+            stages[name] = {'count': len(values), 'total': sum(values),
+                            **{key: percentile(values, fraction) for key, fraction in PERCENTILES},
+                            'max': values[-1]}
+        return {
+            'elapsed': elapsed,
+            'tracks': sum(statuses.values()),
+            'tracks_per_sec': statuses['downloaded'] / elapsed if elapsed else 0.0,
+            'statuses': dict(statuses),
+            'counters': dict(counters),
+            'stages': stages,
+        }
+
+    def close(self) -> None:
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+def enable_stats(path: Optional[str] = None) -> RunStats:
+    """ Starts a new run, writing a json line per song to path """
+    global STATS
+    with STATS_LOCK:
+        if STATS is not None:
+            STATS.close()
+        STATS = RunStats(path)
+        return STATS
+
+
+def get_stats() -> RunStats:
+    global STATS
+    with STATS_LOCK:
+        if STATS is None:
+            STATS = RunStats()
+        return STATS
+
+
+def start_track(track_id: str) -> TrackRecord:
+    """ Starts the record of a song and makes it the current thread's """
+    record = TrackRecord(get_stats(), track_id)
+    CURRENT.record = record
+    return record
+
+
+def set_current(record: Optional[TrackRecord]) -> None:
+    """ Hands the record of a song over to the current thread, e.g. a transcoding worker """
+    CURRENT.record = record
+
+
+def count(name: str, value=1) -> None:
+    """ Adds to a counter of the current thread's song, or of the run outside of one """
+    record = getattr(CURRENT, 'record', None)
+    if record is not None:
+        record.counters[name] += value
+    else:
+        get_stats().count(name, value)
+
+
+def add_time(name: str, seconds: float) -> None:
+    """ Adds time measured elsewhere to a stage of the current thread's song, or of the run outside of one """
+    record = getattr(CURRENT, 'record', None)
+    if record is not None:
+        record.stages[name] += seconds
+    else:
+        get_stats().add_stage(name, seconds)
+
+
+def gauge(name: str, delta: int) -> None:
+    """ Moves a gauge of the run, e.g. the number of queued downloads """
+    get_stats().add_gauge(name, delta)
+
+
+@contextmanager
+def stage(name: str):
+    """ Times a block as a stage of the current thread's song, or of the run outside of one """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(name, time.perf_counter() - start)
+
+
+def print_summary() -> None:
+    summary = get_stats().summary()
+    if not summary['tracks']:
+        return
+    print(f'\n###   {summary["tracks"]} SONGS IN {summary["elapsed"]:.1f}s ({summary["tracks_per_sec"]:.2f}/s)   ###')
+    print('   ' + ', '.join(f'{status}: {number}' for status, number in sorted(summary['statuses'].items())))
+    if summary['counters']:
+        print('   ' + ', '.join(f'{name}: {value}' for name, value in sorted(summary['counters'].items())))
+    print(f'   {"stage":<16}{"count":>7}{"total s":>10}{"p50 ms":>10}{"p90 ms":>10}{"p99 ms":>10}{"max ms":>10}')
+    for name, values in sorted(summary['stages'].items()):
+        print(f'   {name:<16}{values["count"]:>7}{values["total"]:>10.2f}' +
+              ''.join(f'{values[key] * 1000:>10.1f}' for key in ('p50', 'p90', 'p99', 'max')))
@@ -1,7 +1,14 @@
+import hashlib
 import os
 import re
+import subprocess
+import threading
 import time
-from typing import Any, Tuple, List
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from collections import deque
+from itertools import islice
+from operator import length_hint
+from typing import Any, Iterator, Tuple, List, Optional, Union
 
 from librespot.audio.decoders import AudioQuality
 from librespot.metadata import TrackId
@@ -9,50 +16,81 @@ from ffmpy import FFmpeg
 from pydub import AudioSegment
 from tqdm import tqdm
 
-from const import TRACKS, ALBUM, NAME, ITEMS, DISC_NUMBER, TRACK_NUMBER, IS_PLAYABLE, ARTISTS, IMAGES, URL, \
+from const import TRACK, TRACKS, ALBUM, NAME, DISC_NUMBER, TRACK_NUMBER, IS_PLAYABLE, ARTISTS, IMAGES, URL, \
     RELEASE_DATE, ID, TRACKS_URL, SAVED_TRACKS_URL, TRACK_STATS_URL, SPLIT_ALBUM_DISCS, ROOT_PATH, DOWNLOAD_FORMAT, \
-    CHUNK_SIZE, SKIP_EXISTING_FILES, ANTI_BAN_WAIT_TIME, OVERRIDE_AUTO_WAIT, BITRATE, CODEC_MAP, EXT_MAP, DOWNLOAD_REAL_TIME, DURATION_MS
-from utils import fix_filename, set_audio_tags, set_music_thumbnail, create_download_directory, \
-    get_directory_song_ids, add_to_directory_song_ids
+    CHUNK_SIZE, SKIP_EXISTING_FILES, BITRATE, CODEC_MAP, EXT_MAP, DOWNLOAD_REAL_TIME, DURATION_MS, \
+    DOWNLOAD_WORKERS, TRACKS_PER_REQUEST, DEDUPLICATE, TRANSCODE_STREAMING, TRANSCODE_WORKERS, STAGE_IN_MEMORY, \
+    SCRATCH_PATH, MIN_CHUNK_SIZE, SCRATCH_DIR_PATH, SCRATCH_STALE_AGE
+from artwork import get_artwork
+from asyncapi import iter_url_paginated, invoke_urls
+from journal import get_journal
+from library import get_file_checksum, get_library_index
+from staging import stage_in_memory
+from stats import start_track, set_current, stage, gauge
+from utils import fix_filename, set_audio_tags, create_download_directory, copy_stream, move_into_place
 from zspotify import ZSpotify
 
+# Guards filename selection between download workers
+DOWNLOAD_LOCK = threading.Lock()
+RESERVED_FILENAMES = set()
+IN_PROGRESS_IDS = set()
 
-def get_saved_tracks() -> list:
-    """ Returns user's saved tracks """
-    songs = []
-    offset = 0
-    limit = 50
 
-    while True:
-        resp = ZSpotify.invoke_url_with_params(
-            SAVED_TRACKS_URL, limit=limit, offset=offset)
-        offset += limit
-        songs.extend(resp[ITEMS])
-        if len(resp[ITEMS]) < limit:
-            break
+def iter_saved_tracks() -> Iterator[dict]:
+    """ Yields user's saved tracks page by page """
+    return iter_url_paginated(SAVED_TRACKS_URL, limit=50)
 
-    return songs
 
+def get_saved_tracks() -> list:
+    """ Returns user's saved tracks """
+    return list(iter_saved_tracks())
 
-def get_song_info(song_id) -> Tuple[List[str], str, str, Any, Any, Any, Any, Any, Any]:
-    """ Retrieves metadata for downloaded songs """
-    info = ZSpotify.invoke_url(f'{TRACKS_URL}?ids={song_id}&market=from_token')
 
+def parse_song_info(track) -> Tuple[List[str], str, str, Any, Any, Any, Any, Any, Any, Any]:
+    """ Extracts the metadata used for downloading from a track object """
     artists = []
-    for data in info[TRACKS][0][ARTISTS]:
+    for data in track[ARTISTS]:
         artists.append(data[NAME])
-    album_name = info[TRACKS][0][ALBUM][NAME]
-    name = info[TRACKS][0][NAME]
-    image_url = info[TRACKS][0][ALBUM][IMAGES][0][URL]
-    release_year = info[TRACKS][0][ALBUM][RELEASE_DATE].split('-')[0]
-    disc_number = info[TRACKS][0][DISC_NUMBER]
-    track_number = info[TRACKS][0][TRACK_NUMBER]
-    scraped_song_id = info[TRACKS][0][ID]
-    is_playable = info[TRACKS][0][IS_PLAYABLE]
-    duration_ms = info[TRACKS][0][DURATION_MS]
+    album_name = track[ALBUM][NAME]
+    name = track[NAME]
+    image_url = track[ALBUM][IMAGES][0][URL]
+    release_year = track[ALBUM][RELEASE_DATE].split('-')[0]
+    disc_number = track[DISC_NUMBER]
+    track_number = track[TRACK_NUMBER]
+    scraped_song_id = track[ID]
+    is_playable = track[IS_PLAYABLE]
+    duration_ms = track[DURATION_MS]
 
     return artists, album_name, name, image_url, release_year, disc_number, track_number, scraped_song_id, is_playable, duration_ms
 
+
+def get_song_info(song_id) -> Tuple[List[str], str, str, Any, Any, Any, Any, Any, Any, Any]:
+    """ Retrieves metadata for downloaded songs """
+    return get_songs_info([song_id])[song_id]
+
+
+def get_songs_info(song_ids) -> dict:
+    """ Retrieves metadata for many songs, TRACKS_PER_REQUEST ids per request, all requests at once """
+    songs_info = {}
+    missing_ids = []
+    for song_id in song_ids:
+        track = ZSpotify.get_cached(TRACK, song_id)
+        if track:
+            songs_info[song_id] = parse_song_info(track)
+        else:
+            missing_ids.append(song_id)
+
+    batches = [missing_ids[i:i + TRACKS_PER_REQUEST] for i in range(0, len(missing_ids), TRACKS_PER_REQUEST)]
+    responses = invoke_urls([f'{TRACKS_URL}?ids={",".join(batch)}&market=from_token' for batch in batches])
+    for batch, info in zip(batches, responses):
+        # tracks come back in request order, unknown ids as null
+        for song_id, track in zip(batch, info[TRACKS]):
+            if track:
+                ZSpotify.put_cached(TRACK, song_id, track)
+                songs_info[song_id] = parse_song_info(track)
+
+    return songs_info
+
 def get_song_duration(song_id: str) -> float:
     """ Retrieves duration of song in second as is on spotify """
 
@@ -69,13 +107,45 @@ def get_song_duration(song_id: str) -> float:
 
     return duration
 
-# noinspection PyBroadException
-def download_track(track_id: str, extra_paths='', prefix=False, prefix_value='', disable_progressbar=False) -> None:
-    """ Downloads raw song audio from Spotify """
+class DownloadCancelled(BaseException):
+    """ Raised in a download worker when the batch it belongs to was interrupted """
+
+
+class SongDownload:
+    """ A song being downloaded by download_track, with everything finalize_track needs to put it in place """
+
+    def __init__(self, record, song_id, song_name, filename, download_directory, tags, image_url):
+        self.record = record
+        self.song_id = song_id
+        self.song_name = song_name
+        self.filename = filename
+        self.download_directory = download_directory
+        # artists, name, album_name, release_year, disc_number, track_number
+        self.tags = tags
+        self.image_url = image_url
+        # the song is put together there and only moved to filename once it is complete
+        self.scratch_filename = get_scratch_filename(filename)
+        self.part_filename = f'{os.path.splitext(self.scratch_filename)[0]}.part'
+        # the stream already is ogg vorbis, so it only needs ffmpeg for other formats
+        self.needs_conversion = CODEC_MAP.get(ZSpotify.get_config(DOWNLOAD_FORMAT).lower(), 'copy') != 'copy'
+        self.converter = None
+        self.staged = None
+
 
+# noinspection PyBroadException
+def download_track(track_id: str, extra_paths='', prefix=False, prefix_value='', disable_progressbar=False,
+                   song_info=None, transcoder: Optional[Executor] = None,
+                   stop_event: Optional[threading.Event] = None) -> Union[bool, Future]:
+    """ Downloads raw song audio from Spotify, song_info may hold prefetched get_song_info output.
+    Returns whether the song is in place afterwards. With a transcoder, songs that need converting are handed
+    over to it once downloaded and the future of the result is returned instead. Setting stop_event aborts
+    the download at its next chunk """
+
+    record = start_track(track_id)
     try:
-        (artists, album_name, name, image_url, release_year, disc_number,
-         track_number, scraped_song_id, is_playable, duration_ms) = get_song_info(track_id)
+        with record.stage('metadata'):
+            (artists, album_name, name, image_url, release_year, disc_number,
+             track_number, scraped_song_id, is_playable, duration_ms) = song_info or get_song_info(track_id)
 
         if ZSpotify.get_config(SPLIT_ALBUM_DISCS):
             download_directory = os.path.join(os.path.dirname(
@@ -92,77 +162,369 @@ def download_track(track_id: str, extra_paths='', prefix=False, prefix_value='',
         filename = os.path.join(
             download_directory, f'{song_name}.{EXT_MAP.get(ZSpotify.get_config(DOWNLOAD_FORMAT).lower())}')
 
-        check_name = os.path.isfile(filename) and os.path.getsize(filename)
-        check_id = scraped_song_id in get_directory_song_ids(download_directory)
+        with DOWNLOAD_LOCK:
+            check_name = os.path.isfile(filename) and os.path.getsize(filename)
+            check_id = get_library_index().has_song(scraped_song_id, download_directory)
+
+            # the same song is already being downloaded into this directory by another worker
+            in_progress = (download_directory, scraped_song_id) in IN_PROGRESS_IDS
 
-        # a song with the same name is installed
-        if not check_id and check_name:
-            c = len([file for file in os.listdir(download_directory)
-                     if re.search(f'^{song_name}_', file)]) + 1
+            # a song with the same name is installed
+            if not in_progress and not check_id and (check_name or filename in RESERVED_FILENAMES):
+                c = len([file for file in os.listdir(download_directory)
+                         if re.search(f'^{song_name}_', file)]) + 1 if os.path.isdir(download_directory) else 1
 
-            filename = os.path.join(
-                download_directory, f'{song_name}_{c}.{EXT_MAP.get(ZSpotify.get_config(DOWNLOAD_FORMAT))}')
+                filename = os.path.join(
+                    download_directory, f'{song_name}_{c}.{EXT_MAP.get(ZSpotify.get_config(DOWNLOAD_FORMAT))}')
+                while filename in RESERVED_FILENAMES:
+                    c += 1
+                    filename = os.path.join(
+                        download_directory, f'{song_name}_{c}.{EXT_MAP.get(ZSpotify.get_config(DOWNLOAD_FORMAT))}')
 
+            skip_existing = in_progress or (check_id and check_name and ZSpotify.get_config(SKIP_EXISTING_FILES))
+            reserved = not skip_existing
+            if reserved:
+                RESERVED_FILENAMES.add(filename)
+                IN_PROGRESS_IDS.add((download_directory, scraped_song_id))
 
     except Exception as e:
-        print('###   SKIPPING SONG - FAILED TO QUERY METADATA   ###')
-        print(e)
+        tqdm.write('###   SKIPPING SONG - FAILED TO QUERY METADATA   ###')
+        tqdm.write(str(e))
+        record.finish()
     else:
+        transcoding = False
+        song = None
         try:
             if not is_playable:
-                print('\n###   SKIPPING:', song_name,
-                    '(SONG IS UNAVAILABLE)   ###')
+                tqdm.write(f'\n###   SKIPPING: {song_name} (SONG IS UNAVAILABLE)   ###')
+                record.status = 'unavailable'
             else:
-                if check_id and check_name and ZSpotify.get_config(SKIP_EXISTING_FILES):
-                    print('\n###   SKIPPING:', song_name,
-                        '(SONG ALREADY EXISTS)   ###')
-                else:
-                    if track_id != scraped_song_id:
-                        track_id = scraped_song_id
-                    track_id = TrackId.from_base62(track_id)
+                if skip_existing:
+                    tqdm.write(f'\n###   SKIPPING: {song_name} (SONG ALREADY EXISTS)   ###')
+                    record.status = 'skipped'
+                    # a song another worker is still downloading is only in place once that worker succeeds
+                    return not in_progress
+                if ZSpotify.get_config(DEDUPLICATE) != 'none' and get_library_index().link_existing_copy(
+                        scraped_song_id, filename, ZSpotify.get_config(DOWNLOAD_FORMAT).lower(),
+                        ZSpotify.get_config(DEDUPLICATE)):
+                    tqdm.write(f'\n###   LINKED: {song_name} (SONG ALREADY DOWNLOADED ELSEWHERE)   ###')
+                    record.status = 'linked'
+                    return True
+
+                song = SongDownload(record, scraped_song_id, song_name, filename, download_directory,
+                                    (artists, name, album_name, release_year, disc_number, track_number), image_url)
+                with record.stage('stream_open'):
                     stream = ZSpotify.get_content_stream(
-                        track_id, ZSpotify.DOWNLOAD_QUALITY)
-                    create_download_directory(download_directory)
-                    total_size = stream.input_stream.size
-                    time_start = time.time()
-                    download_size = 0
-
-                    with open(filename, 'wb') as file, tqdm(
-                            desc=song_name,
-                            total=total_size,
-                            unit='B',
-                            unit_scale=True,
-                            unit_divisor=1024,
-                            disable=disable_progressbar
-                    ) as p_bar:
-                        for chunk in range(int(total_size / ZSpotify.get_config(CHUNK_SIZE)) + 1):
-                            data = stream.input_stream.stream().read(ZSpotify.get_config(CHUNK_SIZE))
-                            p_bar.update(file.write(data))
-                            download_size += len(data)
-                            if ZSpotify.get_config(DOWNLOAD_REAL_TIME):
-                                delta_real = time.time() - time_start
-                                delta_want = (download_size / total_size) * (duration_ms/1000)
-                                if delta_want > delta_real:
-                                    real_time = delta_want - delta_real
-                                    time.sleep(real_time)
-
-                    convert_audio_format(filename)
-                    set_audio_tags(filename, artists, name, album_name,
-                                release_year, disc_number, track_number)
-                    set_music_thumbnail(filename, image_url)
-
-                    # add song id to download directory's .song_ids file
-                    if not check_id:
-                        add_to_directory_song_ids(download_directory, scraped_song_id)
-
-                    if not ZSpotify.get_config(OVERRIDE_AUTO_WAIT):
-                        time.sleep(ZSpotify.get_config(ANTI_BAN_WAIT_TIME))
+                        TrackId.from_base62(scraped_song_id), ZSpotify.DOWNLOAD_QUALITY)
+                create_download_directory(download_directory)
+                create_download_directory(os.path.dirname(song.scratch_filename))
+                download_audio(song, stream, duration_ms, disable_progressbar, stop_event)
+
+                if transcoder is None or song.converter or not song.needs_conversion:
+                    return finalize_track(song)
+
+                if stop_event is not None and stop_event.is_set():
+                    raise DownloadCancelled()
+                # the filename stays reserved until the transcoding worker is done with it
+                set_current(None)
+                gauge('queued_transcodes', 1)
+                try:
+                    future = transcoder.submit(transcode_track, song, time.perf_counter())
+                except BaseException:
+                    gauge('queued_transcodes', -1)
+                    set_current(record)
+                    raise
+                reserved = False
+                transcoding = True
+                return future
         except Exception as e:
-            print('###   SKIPPING:', song_name,
-                  '(GENERAL DOWNLOAD ERROR)   ###')
-            print(e)
-            if os.path.exists(filename):
-                os.remove(filename)
+            tqdm.write(f'###   SKIPPING: {song_name} (GENERAL DOWNLOAD ERROR)   ###')
+            tqdm.write(str(e))
+            if song is not None and os.path.exists(song.scratch_filename):
+                os.remove(song.scratch_filename)
+        finally:
+            if reserved:
+                release_filename(filename, download_directory, scraped_song_id)
+            if not transcoding:
+                record.finish()
+    return False
+
+
+def download_audio(song: SongDownload, stream, duration_ms, disable_progressbar=False,
+                   stop_event: Optional[threading.Event] = None) -> None:
+    """ Copies the audio stream of a song into its .part file, memory or a streaming ffmpeg converter,
+    raising DownloadCancelled once stop_event is set """
+    record = song.record
+    total_size = stream.input_stream.size
+    time_start = time.time()
+    download_size = 0
+
+    # in streaming mode ffmpeg converts the audio while it is being downloaded
+    if song.needs_conversion and ZSpotify.get_config(TRANSCODE_STREAMING):
+        song.converter = open_audio_converter(song.scratch_filename)
+        file = song.converter.stdin
+    else:
+        # raw audio goes to a .part file first so an interrupted download can be resumed
+        partial = get_journal().get_partial(song.song_id)
+        if ZSpotify.RESUME and partial and partial[0] == song.part_filename and os.path.isfile(song.part_filename):
+            # a crash or kill records no offset, so the file itself tells how far the download got,
+            # less the last chunk which may only have been written in part
+            size = os.path.getsize(song.part_filename)
+            download_size = max(min(partial[1], size), size - size % MIN_CHUNK_SIZE)
+            file = open(song.part_filename, 'r+b')
+            file.truncate(download_size)
+            file.seek(download_size)
+            # seek is absolute, and librespot already moved past the header Spotify puts before the audio
+            audio_stream = stream.input_stream.stream()
+            audio_stream.seek(audio_stream.pos() + download_size)
+        else:
+            if ZSpotify.get_config(STAGE_IN_MEMORY):
+                # songs that fit in the memory budget never touch the disk before being converted
+                song.staged = stage_in_memory(total_size)
+            if song.staged:
+                file = song.staged
+            else:
+                file = open(song.part_filename, 'wb')
+                # recorded up front so the file is resumed even if this process never gets to record its offset
+                get_journal().set_partial(song.song_id, song.part_filename, 0)
+    try:
+        with file, tqdm(
+                desc=song.song_name,
+                total=total_size,
+                initial=download_size,
+                unit='B',
+                unit_scale=True,
+                unit_divisor=1024,
+                disable=disable_progressbar
+        ) as p_bar:
+            download_real_time = ZSpotify.get_config(DOWNLOAD_REAL_TIME)
+
+            def on_chunk(length):
+                nonlocal download_size
+                download_size += length
+                record.counters['bytes'] += length
+                p_bar.update(length)
+                if stop_event is not None and stop_event.is_set():
+                    raise DownloadCancelled()
+                if download_real_time:
+                    delta_real = time.time() - time_start
+                    delta_want = (download_size / total_size) * (duration_ms/1000)
+                    if delta_want > delta_real:
+                        real_time = delta_want - delta_real
+                        with record.stage('sleep'):
+                            time.sleep(real_time)
+
+            copy_stream(stream.input_stream.stream(), file, ZSpotify.get_config(CHUNK_SIZE),
+                        limit=total_size - download_size, on_chunk=on_chunk)
+    except BaseException:
+        if song.converter:
+            song.converter.kill()
+            song.converter.wait()
+        elif song.staged:
+            song.staged.release()
+        elif download_size:
+            get_journal().set_partial(song.song_id, song.part_filename, download_size)
+        elif os.path.exists(song.part_filename):
+            os.remove(song.part_filename)
+            get_journal().clear_partial(song.song_id)
+        raise
+
+
+def finalize_track(song: SongDownload) -> bool:
+    """ Converts, tags, indexes and moves a downloaded song into place, returns whether it is in place """
+    record = song.record
+    try:
+        if song.converter:
+            with record.stage('transcode'):
+                close_audio_converter(song.converter)
+        else:
+            if song.staged:
+                with song.staged.getbuffer() as data:
+                    if song.needs_conversion:
+                        with record.stage('transcode'):
+                            convert_audio_data(song.scratch_filename, data)
+                    else:
+                        with record.stage('write'), open(song.scratch_filename, 'wb') as file:
+                            file.write(data)
+                song.staged.release()
+            elif song.needs_conversion:
+                with record.stage('transcode'):
+                    convert_audio_format(song.scratch_filename, song.part_filename)
+            else:
+                os.replace(song.part_filename, song.scratch_filename)
+            if not song.staged:
+                get_journal().clear_partial(song.song_id)
+        with record.stage('artwork'):
+            image = get_artwork(song.image_url)
+        with record.stage('tagging'):
+            set_audio_tags(song.scratch_filename, *song.tags, image)
+
+        with record.stage('index'):
+            checksum = get_file_checksum(song.scratch_filename)
+        with record.stage('commit'):
+            move_into_place(song.scratch_filename, song.filename)
+        with record.stage('index'):
+            get_library_index().add(song.song_id, song.filename,
+                                    ZSpotify.get_config(DOWNLOAD_FORMAT).lower(), checksum)
+        record.status = 'downloaded'
+        return True
+    except Exception as e:
+        tqdm.write(f'###   SKIPPING: {song.song_name} (GENERAL DOWNLOAD ERROR)   ###')
+        tqdm.write(str(e))
+        if os.path.exists(song.scratch_filename):
+            os.remove(song.scratch_filename)
+        # the audio was downloaded in full, so the .part file is not kept for resuming
+        if not song.converter and os.path.exists(song.part_filename):
+            os.remove(song.part_filename)
+            get_journal().clear_partial(song.song_id)
+        return False
+    finally:
+        if song.staged:
+            song.staged.release()
+
+
+def transcode_track(song: SongDownload, handed_over: float) -> bool:
+    """ Finalizes a song handed over to a transcoding worker by download_track, then releases its filename """
+    record = song.record
+    set_current(record)
+    record.stages['transcode_wait'] += time.perf_counter() - handed_over
+    gauge('queued_transcodes', -1)
+    gauge('active_transcodes', 1)
+    try:
+        return finalize_track(song)
+    finally:
+        gauge('active_transcodes', -1)
+        release_filename(song.filename, song.download_directory, song.song_id)
+        record.finish()
+
+
+def get_scratch_directory() -> str:
+    """ Returns SCRATCH_PATH, or zs_scratch next to the config if it is not set """
+    return os.path.join(os.path.dirname(__file__), ZSpotify.get_config(SCRATCH_PATH) or SCRATCH_DIR_PATH)
+
+
+def get_scratch_filename(filename: str) -> str:
+    """ Returns where the song saved as filename is downloaded, converted and tagged """
+    key = hashlib.sha1(os.path.abspath(filename).encode('utf-8')).hexdigest()[:20]
+    return os.path.join(get_scratch_directory(), key + os.path.splitext(filename)[1])
+
+
+def clean_scratch_directory() -> None:
+    """ Removes files crashed runs left in the scratch directory, keeping .part files that can be resumed """
+    directory = get_scratch_directory()
+    if not os.path.isdir(directory):
+        return
+    partial_paths = {os.path.normpath(path) for path in get_journal().get_partial_paths()}
+    # recent files may belong to another zspotify process using the same directory
+    stale_before = time.time() - SCRATCH_STALE_AGE
+    for entry in os.scandir(directory):
+        try:
+            if entry.is_file() and os.path.normpath(entry.path) not in partial_paths and \
+                    entry.stat().st_mtime < stale_before:
+                os.remove(entry.path)
+        except OSError:
+            continue
+
+
+def release_filename(filename, download_directory, song_id) -> None:
+    """ Lets other workers pick a filename reserved by download_track again """
+    with DOWNLOAD_LOCK:
+        RESERVED_FILENAMES.discard(filename)
+        IN_PROGRESS_IDS.discard((download_directory, song_id))
+
+
+def download_tracks(track_ids, extra_paths='', prefix=False, desc=None, total=None, skip_ids=None) -> set:
+    """ Downloads several songs at once using DOWNLOAD_WORKERS threads, converting them in TRANSCODE_WORKERS others.
+    track_ids may be a lazy iterator, songs start downloading as soon as its first items arrive.
+    Finished songs are journaled per extra_paths so an interrupted run can be resumed, songs in skip_ids
+    are left out. Returns the ids of the songs that are in place afterwards """
+    track_ids = iter(track_ids)
+    total = total or length_hint(track_ids) or None
+    workers = max(1, int(ZSpotify.get_config(DOWNLOAD_WORKERS) or 1))
+    transcode_workers = max(1, int(ZSpotify.get_config(TRANSCODE_WORKERS) or os.cpu_count() or 1))
+    finished_ids = get_journal().start_job(extra_paths, ZSpotify.RESUME) | set(skip_ids or ())
+    clean_scratch_directory()
+    done_ids = set()
+    # downloaded songs wait on disk for a transcoding worker, this bounds how many can pile up
+    in_flight = threading.Semaphore(workers + 2 * transcode_workers)
+    # set when the batch is interrupted, e.g. by Ctrl-C, so running downloads stop at their next chunk
+    stop_event = threading.Event()
+    # the download pool is shut down first, then the transcoding pool finishes what it was handed
+    with tqdm(desc=desc, total=total, unit='song', unit_scale=True) as p_bar, \
+            ThreadPoolExecutor(max_workers=transcode_workers) as transcoder, \
+            ThreadPoolExecutor(max_workers=workers) as executor:
+        def finish(track_id, done):
+            if done:
+                get_journal().mark_done(extra_paths, track_id)
+                done_ids.add(track_id)
+            p_bar.update(1)
+            in_flight.release()
+
+        def finish_transcoded(track_id, future):
+            # a failed or cancelled transcode still has to free its slot, or the download workers would stall
+            try:
+                done = future.result()
+            except BaseException:
+                done = False
+            finish(track_id, done)
+
+        def download(n, track_id, song_info):
+            in_flight.acquire()
+            gauge('queued_downloads', -1)
+            gauge('active_downloads', 1)
+            done = False
+            try:
+                if not stop_event.is_set():
+                    done = download_track(track_id, extra_paths, prefix=prefix, prefix_value=str(n),
+                                          disable_progressbar=True, song_info=song_info, transcoder=transcoder,
+                                          stop_event=stop_event)
+            finally:
+                gauge('active_downloads', -1)
+                if isinstance(done, Future):
+                    done.add_done_callback(lambda future: finish_transcoded(track_id, future))
+                else:
+                    finish(track_id, done)
+
+        futures = deque()
+        position = 0
+        try:
+            while True:
+                batch = list(islice(track_ids, TRACKS_PER_REQUEST))
+                if not batch:
+                    break
+                # positions are kept for the prefix even when finished songs are left out
+                batch_size = len(batch)
+                done_ids.update(track_id for track_id in batch if track_id in finished_ids)
+                batch = [(n, track_id) for n, track_id in enumerate(batch, start=position + 1)
+                         if track_id not in finished_ids]
+                p_bar.update(batch_size - len(batch))
+                position += batch_size
+                if not batch:
+                    continue
+                try:
+                    with stage('metadata_prefetch'):
+                        songs_info = get_songs_info([track_id for _, track_id in batch])
+                except Exception as e:
+                    # fall back to one metadata request per song
+                    tqdm.write('###   FAILED TO PREFETCH METADATA   ###')
+                    tqdm.write(str(e))
+                    songs_info = {}
+                gauge('queued_downloads', len(batch))
+                futures.extend(executor.submit(download, n, track_id, songs_info.get(track_id))
+                               for n, track_id in batch)
+                # stay about one batch ahead of the workers so memory does not grow with the listing
+                while len(futures) > workers + TRACKS_PER_REQUEST:
+                    futures.popleft().result()
+            for future in futures:
+                future.result()
+        except BaseException:
+            # without this the pools would work through every queued song before letting the interrupt through
+            stop_event.set()
+            transcoder.shutdown(wait=False, cancel_futures=True)
+            executor.shutdown(wait=True, cancel_futures=True)
+            transcoder.shutdown(wait=True, cancel_futures=True)
+            raise
+    return done_ids
 
 
 def get_segment_duration(segment):
@@ -177,11 +539,8 @@ def get_segment_duration(segment):
     return duration
 
 
-def convert_audio_format(filename) -> None:
-    """ Converts raw audio into playable file """
-    temp_filename = f'{os.path.splitext(filename)[0]}.tmp'
-    os.replace(filename, temp_filename)
-
+def get_output_params() -> List[str]:
+    """ Returns the ffmpeg output options for DOWNLOAD_FORMAT """
     download_format = ZSpotify.get_config(DOWNLOAD_FORMAT).lower()
     file_codec = CODEC_MAP.get(download_format, "copy")
     if file_codec != 'copy':
@@ -197,12 +556,46 @@ def convert_audio_format(filename) -> None:
     output_params = ['-c:a', file_codec]
     if bitrate:
         output_params += ['-b:a', bitrate]
+    return output_params
+
+
+def convert_audio_format(filename, temp_filename=None) -> None:
+    """ Converts raw audio into playable file, reading it from temp_filename if given """
+    if temp_filename is None:
+        temp_filename = f'{os.path.splitext(filename)[0]}.tmp'
+        os.replace(filename, temp_filename)
 
     ff_m = FFmpeg(
         global_options=['-y', '-hide_banner', '-loglevel error'],
         inputs={temp_filename: None},
-        outputs={filename: output_params}
+        outputs={filename: get_output_params()}
     )
     ff_m.run()
     if os.path.exists(temp_filename):
         os.remove(temp_filename)
+
+
+def convert_audio_data(filename, data) -> None:
+    """ Converts raw audio held in memory into playable file """
+    converter = open_audio_converter(filename)
+    try:
+        converter.stdin.write(data)
+    except BaseException:
+        converter.kill()
+        converter.wait()
+        raise
+    close_audio_converter(converter)
+
+
+def open_audio_converter(filename) -> subprocess.Popen:
+    """ Starts ffmpeg converting raw audio written to its stdin into a playable file """
+    return subprocess.Popen(['ffmpeg', '-y', '-hide_banner', '-loglevel', 'error', '-i', 'pipe:0',
+                             *get_output_params(), filename], stdin=subprocess.PIPE)
+
+
+def close_audio_converter(converter: subprocess.Popen) -> None:
+    """ Waits for ffmpeg to finish the file after all audio was written to its stdin """
+    if converter.stdin and not converter.stdin.closed:
+        converter.stdin.close()
+    if converter.wait() != 0:
+        raise RuntimeError(f'ffmpeg exited with code {converter.returncode}')
@@ -1,16 +1,19 @@
+import errno
 import os
 import platform
 import re
+import shutil
 import subprocess
+import tempfile
 import time
 from enum import Enum
-from typing import List, Tuple
+from typing import Callable, List, Optional, Tuple
 
 import music_tag
-import requests
 
 from const import ARTIST, TRACKTITLE, ALBUM, YEAR, DISCNUMBER, TRACKNUMBER, ARTWORK, \
-    WINDOWS_SYSTEM, ALBUMARTIST
+    WINDOWS_SYSTEM, ALBUMARTIST, MIN_CHUNK_SIZE, MAX_CHUNK_SIZE, CHUNK_READ_TIME
+from stats import add_time
 
 
 class MusicFormat(str, Enum):
@@ -19,17 +22,73 @@ class MusicFormat(str, Enum):
 
 
 def create_download_directory(download_path: str) -> None:
-    """ Create directory and add a hidden file with song ids """
+    """ Create directory """
     os.makedirs(download_path, exist_ok=True)
 
-    # add hidden file with song ids
-    hidden_file_path = os.path.join(download_path, '.song_ids')
-    if not os.path.isfile(hidden_file_path):
-        with open(hidden_file_path, 'w', encoding='utf-8') as f:
-            pass
+
+def move_into_place(source: str, target: str) -> None:
+    """ Moves a finished file to target in one step, so target is either missing or complete """
+    try:
+        os.replace(source, target)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+
+    # across filesystems the file is copied next to target first, so only a rename makes it visible
+    fd, temp_target = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=os.path.dirname(target) or os.curdir)
+    try:
+        with open(fd, 'wb') as file, open(source, 'rb') as source_file:
+            shutil.copyfileobj(source_file, file, MAX_CHUNK_SIZE)
+            file.flush()
+            os.fsync(file.fileno())
+        shutil.copymode(source, temp_target)
+        os.replace(temp_target, target)
+    except BaseException:
+        os.remove(temp_target)
+        raise
+    os.remove(source)
+
+
+def copy_stream(source, target, chunk_size: int, limit: Optional[int] = None,
+                on_chunk: Optional[Callable[[int], None]] = None) -> int:
+    """ Copies source into target until EOF or limit bytes. The read size starts at chunk_size and adapts so
+    a read takes about CHUNK_READ_TIME seconds. on_chunk is called with the size of every chunk written,
+    returns the number of bytes copied """
+    size = min(max(chunk_size, MIN_CHUNK_SIZE), MAX_CHUNK_SIZE)
+    copied = 0
+    read_time = write_time = 0.0
+    try:
+        while limit is None or copied < limit:
+            wanted = size if limit is None else min(size, limit - copied)
+            start = time.perf_counter()
+            data = source.read(wanted)
+            length = len(data)
+            elapsed = time.perf_counter() - start
+            read_time += elapsed
+            if not length:
+                break
+
+            start = time.perf_counter()
+            target.write(data)
+            write_time += time.perf_counter() - start
+            copied += length
+            if on_chunk:
+                on_chunk(length)
+
+            # fast reads get bigger so the loop runs less often, slow ones smaller to keep progress moving
+            if length == size and elapsed < CHUNK_READ_TIME / 2:
+                size = min(size * 2, MAX_CHUNK_SIZE)
+            elif elapsed > CHUNK_READ_TIME * 2:
+                size = max(size // 2, MIN_CHUNK_SIZE)
+    finally:
+        add_time('stream_read', read_time)
+        add_time('write', write_time)
+    return copied
+
 
 def get_directory_song_ids(download_path: str) -> List[str]:
-    """ Gets song ids of songs in directory """
+    """ Gets song ids of songs in directory from the .song_ids file of older versions """
 
     song_ids = []
 
@@ -40,15 +99,6 @@ def get_directory_song_ids(download_path: str) -> List[str]:
 
     return song_ids
 
-def add_to_directory_song_ids(download_path: str, song_id: str) -> None:
-    """ Appends song_id to .song_ids file in directory """
-
-    hidden_file_path = os.path.join(download_path, '.song_ids')
-    # not checking if file exists because we need an exception
-    # to be raised if something is wrong
-    with open(hidden_file_path, 'a', encoding='utf-8') as file:
-        file.write(f'{song_id}\n')
-
 def get_downloaded_song_duration(filename: str) -> float:
     """ Returns the downloaded file's duration in seconds """
 
@@ -99,8 +149,9 @@ def clear() -> None:
         os.system('clear')
 
 
-def set_audio_tags(filename, artists, name, album_name, release_year, disc_number, track_number) -> None:
-    """ sets music_tag metadata """
+def set_audio_tags(filename, artists, name, album_name, release_year, disc_number, track_number,
+                   artwork=None) -> None:
+    """ sets music_tag metadata and cover artwork, saving the file once """
     tags = music_tag.load_file(filename)
     tags[ALBUMARTIST] = artists[0]
     tags[ARTIST] = conv_artist_format(artists)
@@ -109,6 +160,8 @@ def set_audio_tags(filename, artists, name, album_name, release_year, disc_numbe
     tags[YEAR] = release_year
     tags[DISCNUMBER] = disc_number
     tags[TRACKNUMBER] = track_number
+    if artwork:
+        tags[ARTWORK] = artwork
     tags.save()
 
 
@@ -117,14 +170,6 @@ def conv_artist_format(artists) -> str:
     return ', '.join(artists)
 
 
-def set_music_thumbnail(filename, image_url) -> None:
-    """ Downloads cover artwork """
-    img = requests.get(image_url).content
-    tags = music_tag.load_file(filename)
-    tags[ARTWORK] = img
-    tags.save()
-
-
 def regex_input_for_urls(search_input) -> Tuple[str, str, str, str, str, str]:
     """ Since many kinds of search may be passed at the command line, process them all here. """
     track_uri_search = re.search(
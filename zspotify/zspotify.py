@@ -9,23 +9,40 @@ It's like youtube-dl, but for Spotify.
 import json
 import os
 import os.path
+import threading
+import time
 from getpass import getpass
-from typing import Any
+from typing import Any, Optional
+from urllib.parse import urlencode
 
 import requests
 from librespot.audio.decoders import VorbisOnlyAudioQuality
 from librespot.core import Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from const import CREDENTIALS_JSON, TYPE, \
     PREMIUM, USER_READ_EMAIL, AUTHORIZATION, OFFSET, LIMIT, CONFIG_FILE_PATH, FORCE_PREMIUM, \
-    PLAYLIST_READ_PRIVATE, USER_LIBRARY_READ, CONFIG_DEFAULT_SETTINGS
-from utils import MusicFormat
+    PLAYLIST_READ_PRIVATE, USER_LIBRARY_READ, CONFIG_DEFAULT_SETTINGS, HTTP_POOL_SIZE, HTTP_TIMEOUT, HTTP_RETRIES, \
+    TOKEN_EXPIRY_MARGIN, API_RATE_LIMIT, API_RATE_BURST, API_MAX_RETRIES, API_MAX_BACKOFF, METADATA_CACHE, \
+    METADATA_CACHE_TTL, METADATA_CACHE_FILE_PATH
+from cache import MetadataCache
+from ratelimiter import RateLimiter
+from stats import count, stage
 
 
 class ZSpotify:
     SESSION: Session = None
     DOWNLOAD_QUALITY = None
+    RESUME = False
+    SYNC = False
     CONFIG = {}
+    HTTP_SESSION: requests.Session = None
+    HTTP_SESSION_LOCK = threading.Lock()
+    TOKENS = {}
+    TOKENS_LOCK = threading.Lock()
+    RATE_LIMITER: RateLimiter = None
+    METADATA_CACHE: MetadataCache = None
 
     def __init__(self):
         ZSpotify.load_config()
@@ -66,15 +83,176 @@ class ZSpotify:
 
     @classmethod
     def get_config(cls, key) -> Any:
-        return cls.CONFIG.get(key)
+        return cls.CONFIG.get(key, CONFIG_DEFAULT_SETTINGS.get(key))
+
+    @classmethod
+    def get_http_session(cls) -> requests.Session:
+        """ Returns the keep-alive session shared by every http request """
+        with cls.HTTP_SESSION_LOCK:
+            if cls.HTTP_SESSION is None:
+                pool_size = cls.get_config(HTTP_POOL_SIZE)
+                # only connection errors are retried here, error statuses are handled by request()
+                retries = Retry(total=cls.get_config(HTTP_RETRIES), backoff_factor=0.5,
+                                allowed_methods=frozenset(['GET']), respect_retry_after_header=False)
+                adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries)
+                session = requests.Session()
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                cls.HTTP_SESSION = session
+            return cls.HTTP_SESSION
+
+    @classmethod
+    def http_get(cls, url, **kwargs) -> requests.Response:
+        """ GET request through the shared session with the configured timeout """
+        kwargs.setdefault('timeout', cls.get_config(HTTP_TIMEOUT))
+        return cls.get_http_session().get(url, **kwargs)
+
+    @classmethod
+    def get_rate_limiter(cls) -> RateLimiter:
+        """ Returns the token bucket shared by every Web API request """
+        with cls.HTTP_SESSION_LOCK:
+            if cls.RATE_LIMITER is None:
+                cls.RATE_LIMITER = RateLimiter(cls.get_config(API_RATE_LIMIT), cls.get_config(API_RATE_BURST))
+            return cls.RATE_LIMITER
+
+    @classmethod
+    def request(cls, url, params=None, headers=None) -> requests.Response:
+        """ Authenticated, rate limited Web API request, retrying 401, 429 and 5xx responses """
+        max_retries = cls.get_config(API_MAX_RETRIES)
+        for attempt in range(max_retries + 1):
+            with stage('api_wait'):
+                cls.get_rate_limiter().acquire()
+            with stage('api'):
+                resp = cls.http_get(url, headers={**cls.get_auth_header(), **(headers or {})}, params=params)
+            count('api_calls')
+            if resp.status_code == 401 and attempt == 0:
+                # token revoked before its expiry, fetch a new one
+                cls.clear_tokens()
+                continue
+            if resp.status_code != 429 and resp.status_code < 500:
+                return resp
+            if attempt == max_retries:
+                break
+            delay = cls.get_retry_delay(resp.headers.get('Retry-After', ''), attempt)
+            count('api_retries')
+            if resp.status_code == 429:
+                count('rate_limited')
+                # the budget is per account, so every worker has to back off
+                cls.get_rate_limiter().block(delay)
+            else:
+                time.sleep(delay)
+        resp.raise_for_status()
+        return resp
+
+    @staticmethod
+    def get_retry_delay(retry_after: str, attempt: int) -> float:
+        """ Seconds to wait before retrying a 429 or 5xx response """
+        return int(retry_after) if retry_after.isdigit() else min(2 ** attempt, API_MAX_BACKOFF)
+
+    @classmethod
+    def get_metadata_cache(cls) -> Optional[MetadataCache]:
+        """ Returns the on-disk metadata cache, or None if METADATA_CACHE is disabled """
+        if not cls.get_config(METADATA_CACHE):
+            return None
+        with cls.HTTP_SESSION_LOCK:
+            if cls.METADATA_CACHE is None:
+                cls.METADATA_CACHE = MetadataCache(os.path.join(os.path.dirname(__file__), METADATA_CACHE_FILE_PATH))
+            return cls.METADATA_CACHE
+
+    @classmethod
+    def get_cached(cls, kind, key) -> Any:
+        """ Returns a cached value, or None if it is missing or older than its METADATA_CACHE_TTL """
+        cache = cls.get_metadata_cache()
+        if cache is None:
+            return None
+        entry = cache.get(kind, key)
+        if entry is None or not cls.is_fresh(kind, entry[2]):
+            count('cache_misses')
+            return None
+        count('cache_hits')
+        return entry[0]
+
+    @classmethod
+    def is_fresh(cls, kind, fetched_at) -> bool:
+        return time.time() - fetched_at < cls.get_config(METADATA_CACHE_TTL).get(kind, 0)
+
+    @staticmethod
+    def get_cache_key(url, params, cache_key=None) -> str:
+        """ Key of a response in the metadata cache, cache_key replaces the url when given """
+        cache_key = cache_key or url
+        if params:
+            cache_key = f'{cache_key}?{urlencode(sorted(params.items()))}'
+        return cache_key
+
+    @classmethod
+    def put_cached(cls, kind, key, value, etag=None) -> None:
+        cache = cls.get_metadata_cache()
+        if cache:
+            cache.put(kind, key, value, etag)
+
+    @classmethod
+    def invoke_cached(cls, url, params, cache_kind, cache_key=None):
+        """ Returns the json response of url, served from the metadata cache while fresh.
+        cache_key replaces the url in the key, e.g. to tie it to a playlist snapshot """
+        if cls.get_metadata_cache() is None:
+            return cls.request(url, params=params).json()
+        cache_key = cls.get_cache_key(url, params, cache_key)
+
+        cache = cls.get_metadata_cache()
+        entry = cache.get(cache_kind, cache_key)
+        if entry is not None:
+            value, etag, fetched_at = entry
+            if cls.is_fresh(cache_kind, fetched_at):
+                count('cache_hits')
+                return value
+            # an expired entry can still be confirmed with a conditional request
+            if etag:
+                resp = cls.request(url, params=params, headers={'If-None-Match': etag})
+                if resp.status_code == 304:
+                    count('cache_revalidated')
+                    cache.touch(cache_kind, cache_key)
+                    return value
+                count('cache_misses')
+                return cls.__store_response(cache_kind, cache_key, resp)
+        count('cache_misses')
+        return cls.__store_response(cache_kind, cache_key, cls.request(url, params=params))
+
+    @classmethod
+    def __store_response(cls, cache_kind, cache_key, resp):
+        data = resp.json()
+        if resp.ok:
+            cls.get_metadata_cache().put(cache_kind, cache_key, data, resp.headers.get('ETag'))
+        return data
 
     @classmethod
     def get_content_stream(cls, content_id, quality):
         return cls.SESSION.content_feeder().load(content_id, VorbisOnlyAudioQuality(quality), False, None)
 
+    @classmethod
+    def get_token(cls, *scopes) -> str:
+        """ Returns an access token for the scopes, reused until TOKEN_EXPIRY_MARGIN seconds before it expires """
+        key = frozenset(scopes)
+        cached = cls.TOKENS.get(key)
+        if cached is None or cached[1] <= time.time():
+            with cls.TOKENS_LOCK:
+                # another thread may have refreshed it while we waited
+                cached = cls.TOKENS.get(key)
+                if cached is None or cached[1] <= time.time():
+                    token = cls.SESSION.tokens().get_token(*scopes)
+                    # librespot may hand out a cached token, so its lifetime counts from when it was issued,
+                    # given in microseconds since the epoch
+                    cached = (token.access_token, token.timestamp / 1000000 + token.expires_in - TOKEN_EXPIRY_MARGIN)
+                    cls.TOKENS[key] = cached
+        return cached[0]
+
+    @classmethod
+    def clear_tokens(cls) -> None:
+        with cls.TOKENS_LOCK:
+            cls.TOKENS.clear()
+
     @classmethod
     def __get_auth_token(cls):
-        return cls.SESSION.tokens().get_token(USER_READ_EMAIL, PLAYLIST_READ_PRIVATE, USER_LIBRARY_READ).access_token
+        return cls.get_token(USER_READ_EMAIL, PLAYLIST_READ_PRIVATE, USER_LIBRARY_READ)
 
     @classmethod
     def get_auth_header(cls):
@@ -91,15 +269,18 @@ class ZSpotify:
         }, {LIMIT: limit, OFFSET: offset}
 
     @classmethod
-    def invoke_url_with_params(cls, url, limit, offset, **kwargs):
-        headers, params = cls.get_auth_header_and_params(limit=limit, offset=offset)
+    def invoke_url_with_params(cls, url, limit, offset, cache_kind=None, cache_key=None, **kwargs):
+        params = {LIMIT: limit, OFFSET: offset}
         params.update(kwargs)
-        return requests.get(url, headers=headers, params=params).json()
+        if cache_kind:
+            return cls.invoke_cached(url, params, cache_kind, cache_key)
+        return cls.request(url, params=params).json()
 
     @classmethod
-    def invoke_url(cls, url):
-        headers = cls.get_auth_header()
-        return requests.get(url, headers=headers).json()
+    def invoke_url(cls, url, cache_kind=None, cache_key=None):
+        if cache_kind:
+            return cls.invoke_cached(url, None, cache_kind, cache_key)
+        return cls.request(url).json()
 
     @classmethod
     def check_premium(cls) -> bool: